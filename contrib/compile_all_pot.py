@@ -12,24 +12,35 @@ all.pot has several inputs:
 
 We read from each of them.  To aid development, we do this by
 extracting strings from each file individually, then combining them.
-We save each extracted string as a pickled polib.POFile, which is
-faster to read and write than either a normal .po file or a .mo file.
+We save each extracted string as a marshalled list of flattened
+polib.POEntry fields, which is faster to read and write than either a
+normal .po file, a .mo file, or a pickled polib.POFile.  Despite their
+name, the .pot.pickle files are thus *not* pickles: always read them
+with _read_pofile(), which gives back a polib.POFile.
 """
 
 from __future__ import absolute_import
 
-import cPickle
-import collections
 import json
+import marshal
 import os
 import re
 
+try:
+    # The scandir backport's walk() gets file types from the directory
+    # listing, rather than stat-ing every entry like python2's
+    # os.walk() does.  (python3's os.walk() already does this.)
+    from scandir import walk as _walk
+except ImportError:
+    _walk = os.walk
+
 from shared import ka_root
 from third_party import polib
 
 import js_css_packages.packages
 import js_css_packages.util
 from kake.lib import compile_rule
+from kake.lib import compile_util
 from kake.lib import computed_inputs
 from kake.lib import log
 
@@ -46,38 +57,131 @@ _DATASTORE_FILE = 'intl/datastore'
 _MANUAL_TRANSLATION_JSON_FILE = os.path.join('intl', 'manual.json')
 _MANUAL_TRANSLATION_CSV_FILE = os.path.join('intl', 'manual.csv')
 
+# When extracting strings from files, we extract in sub-processes if
+# there are at least this many files to extract from.  For fewer
+# files, the cost of starting up the pool outweighs the gain.
+_MIN_FILES_FOR_PARALLEL_EXTRACT = 8
+
+# The POEntry fields that _write_pofile() saves and _read_pofile()
+# restores.  Other fields -- tcomment, obsolete, and the previous_*
+# fields -- are dropped, as is the POFile's metadata; nothing we
+# extract sets them.  If you change this, update the version() of
+# every compile rule that reads or writes a pofile, including
+# SplitPOFile in compile_small_mo.py.
+_POENTRY_FIELDS = ('msgid', 'msgid_plural', 'msgstr', 'msgstr_plural',
+                   'occurrences', 'msgctxt', 'comment', 'flags')
+
+# Version 2 is the newest marshal format that python2 knows about.
+_MARSHAL_VERSION = 2
+
+# polib writes the human-readable debug file a line at a time, so we
+# give it a large buffer to batch those into fewer syscalls.
+_DEBUG_FILE_BUFFER_SIZE = 1 << 20
+
+# Used to sort datastore entities by the first url they appear in.
+_URL_RE = re.compile(r'<http[^>]*>')
+
+# Matches the files that app.yaml says to skip even for dev_appserver.
+_SKIP_TEST_FILES_RE = re.compile(r'^.*_test\..*$')
+
+# The label file for a given graphie sha, relative to ka-root.
+_GRAPHIE_LABEL_FILE_PATTERN = os.path.join('genfiles', 'labels', 'en',
+                                           '%s-data.json')
+
+# The extractors that run babel's (slow) tokenizer over the entire
+# input file.  For these, we first check if the file has any
+# translation keywords in it at all; see _may_call_keywords().
+_TOKENIZING_EXTRACTORS = frozenset(['python', 'javascript'])
+
+# A map from a frozenset of translation keywords to the compiled
+# regexp that _may_call_keywords() uses to look for calls to them.
+_KEYWORD_CALL_RES = {}
+
+# A cache of the .js files listed in a package manifest, since
+# all.pot is recomputed on every build but the manifest rarely
+# changes.  The key is the absolute path to the manifest, and the
+# value is ((mtime, size), list of files relative to ka-root).
+_MANIFEST_JS_FILES_CACHE = {}
+
+
+# The functions that extract strings from a file, in string form.
+# We look at these maps in order: first the exact filename, then the
+# extension (for extensions that take precedence over the
+# directory), then the directory prefix, then the remaining extensions.
+_EXTRACTOR_BY_FILENAME = {
+    _MANUAL_TRANSLATION_JSON_FILE: 'intl.babel:babel_extract_json',
+    _MANUAL_TRANSLATION_CSV_FILE: 'intl.babel:babel_extract_csv',
+    _DATASTORE_FILE: 'content.babel:babel_extract',
+}
+_EXTRACTOR_BY_PRIMARY_EXTENSION = {
+    '.handlebars': 'handlebars.babel:babel_extract',
+}
+# A list of (prefix, extension-or-None, extractor) triples.
+_EXTRACTOR_BY_PREFIX = (
+    ('search/', '.xml', 'search.babel:babel_extract'),
+    ('genfiles/labels/', None, 'intl.graphie_labels:babel_extract'),
+    ('templates/', None, 'shared_jinja:babel_extract'),
+)
+_EXTRACTOR_BY_EXTENSION = {
+    '.py': 'python',              # a special function hard-coded into babel
+    '.js': 'javascript',          # a special function hard-coded into babel
+}
+
 
 def _extractor(filename):
     """Return the string form of the fn that extracts strings from filename."""
-    if filename == _MANUAL_TRANSLATION_JSON_FILE:
-        return 'intl.babel:babel_extract_json'
+    extractor = _EXTRACTOR_BY_FILENAME.get(filename)
+    if extractor:
+        return extractor
 
-    if filename == _MANUAL_TRANSLATION_CSV_FILE:
-        return 'intl.babel:babel_extract_csv'
+    extension = os.path.splitext(filename)[1]
+    extractor = _EXTRACTOR_BY_PRIMARY_EXTENSION.get(extension)
+    if extractor:
+        return extractor
 
-    if filename == _DATASTORE_FILE:
-        return 'content.babel:babel_extract'
+    for (prefix, prefix_extension, extractor) in _EXTRACTOR_BY_PREFIX:
+        if (filename.startswith(prefix) and
+                prefix_extension in (None, extension)):
+            return extractor
 
-    if filename.endswith('.handlebars'):
-        return 'handlebars.babel:babel_extract'
+    extractor = _EXTRACTOR_BY_EXTENSION.get(extension)
+    if extractor:
+        return extractor
 
-    if filename.startswith('search/') and filename.endswith('.xml'):
-        return 'search.babel:babel_extract'
+    raise compile_rule.BadRequestFailure(
+        'No rule to extract strings from %s' % filename)
 
-    if filename.startswith('genfiles/labels/'):
-        return 'intl.graphie_labels:babel_extract'
 
-    if filename.startswith('templates/'):
-        return 'shared_jinja:babel_extract'
+def _relpath_prefix(rootdir):
+    """Return the prefix that makes files in rootdir ka-root-relative.
 
-    if filename.endswith('.py'):
-        return 'python'           # a special function hard-coded into babel
+    This is faster than calling os.path.join() on every file, which
+    matters since we list tens of thousands of them.  rootdir must be
+    a directory as returned by os.walk(), so it is already normalized.
+    """
+    reldir = ka_root.relpath(rootdir)
+    if reldir == '.':
+        return ''
+    return reldir + os.sep
 
-    if filename.endswith('.js'):
-        return 'javascript'       # a special function hard-coded into babel
 
-    raise compile_rule.BadRequestFailure(
-        'No rule to extract strings from %s' % filename)
+def _keyword_call_re(keywords):
+    """Return a compiled regexp matching a call to any of keywords."""
+    key = frozenset(keywords)
+    if key not in _KEYWORD_CALL_RES:
+        keywords_re = '|'.join(re.escape(k) for k in sorted(key))
+        _KEYWORD_CALL_RES[key] = re.compile(r'(?:%s)\s*\(' % keywords_re)
+    return _KEYWORD_CALL_RES[key]
+
+
+def _may_call_keywords(contents, keyword_call_re):
+    """Return False if contents cannot have a call to any of the keywords.
+
+    keyword_call_re should be as returned by _keyword_call_re().  This
+    is a quick pre-check before running babel: it can have false
+    positives (in comments or strings, say), but no false negatives.
+    """
+    return keyword_call_re.search(contents) is not None
 
 
 def _python_files():
@@ -90,20 +194,22 @@ def _python_files():
     and in genfiles/compiled_handlebars_py, which was translated
     before being compiled.
     """
-    for (rootdir, dirs, files) in os.walk(ka_root.root):
+    for (rootdir, dirs, files) in _walk(ka_root.root):
         # Go backwards so we can erase as we go.
         for i in xrange(len(dirs) - 1, -1, -1):
-            # If we're not a python module, no need to recurse further.
-            if not os.path.exists(os.path.join(rootdir, dirs[i],
-                                               '__init__.py')):
+            if dirs[i] in ('third_party', 'compiled_handlebars_py'):
                 del dirs[i]
-            elif dirs[i] in ('third_party', 'compiled_handlebars_py'):
+            # If we're not a python module, no need to recurse further.
+            # Checking for __init__.py before we descend costs one
+            # stat, rather than listing the whole directory.
+            elif not os.path.exists(os.path.join(rootdir, dirs[i],
+                                                 '__init__.py')):
                 del dirs[i]
 
-        reldir = ka_root.relpath(rootdir)
+        prefix = _relpath_prefix(rootdir)
         for f in files:
             if f.endswith('.py') and f != '__init__.py':
-                yield os.path.normpath(os.path.join(reldir, f))
+                yield prefix + f
 
 
 def _javascript_files(manifest_file):
@@ -125,12 +231,8 @@ def _javascript_files(manifest_file):
     # not be necessary if we never actually try to build all.pot
     from deploy import list_files_uploaded_to_appengine
 
-    packages = js_css_packages.packages.read_package_manifest(manifest_file)
-    for (_, f) in js_css_packages.util.all_files(packages):
-        if f.endswith('.js'):
-            yield f
-        elif f.endswith('.jsx'):
-            yield os.path.join('genfiles', 'compiled_jsx', 'en', f + '.js')
+    for f in _manifest_javascript_files(manifest_file):
+        yield f
 
     # There are some files that we load directly, that aren't part of
     # any package.  We get the list of such files from app.yaml skip-files.
@@ -144,6 +246,33 @@ def _javascript_files(manifest_file):
             yield f
 
 
+def _manifest_javascript_files(manifest_file):
+    """Return the .js files listed in manifest_file (or compiled from .jsx).
+
+    We cache the result, and only re-read manifest_file if its mtime
+    or size has changed.
+    """
+    abs_manifest_file = ka_root.join(manifest_file)
+    s = os.stat(abs_manifest_file)
+    (cached_mtime_and_size, cached_files) = _MANIFEST_JS_FILES_CACHE.get(
+        abs_manifest_file, (None, None))
+    if cached_mtime_and_size == (s.st_mtime, s.st_size):
+        return cached_files
+
+    retval = []
+    packages = js_css_packages.packages.read_package_manifest(manifest_file)
+    for (_, f) in js_css_packages.util.all_files(packages):
+        if f.endswith('.js'):
+            retval.append(f)
+        elif f.endswith('.jsx'):
+            retval.append(
+                os.path.join('genfiles', 'compiled_jsx', 'en', f + '.js'))
+
+    _MANIFEST_JS_FILES_CACHE[abs_manifest_file] = (
+        (s.st_mtime, s.st_size), retval)
+    return retval
+
+
 def _handlebars_files():
     """Yield all handlebars files that might have text-to-translate.
 
@@ -154,12 +283,11 @@ def _handlebars_files():
     filter out the ones we don't care about.
     """
     root = ka_root.join('javascript')
-    for (rootdir, dirs, files) in os.walk(root):
-        reldir = ka_root.relpath(rootdir)
+    for (rootdir, dirs, files) in _walk(root):
+        prefix = _relpath_prefix(rootdir)
         for f in files:
             if f.endswith('.handlebars'):
-                relpath = os.path.join(reldir, f)
-                yield os.path.normpath(relpath)
+                yield prefix + f
 
 
 def _jinja2_files():
@@ -170,12 +298,11 @@ def _jinja2_files():
     We assume all .html and .txt files under templates/ is jinja2.
     """
     root = ka_root.join('templates')
-    for (rootdir, dirs, files) in os.walk(root):
-        reldir = ka_root.relpath(rootdir)
+    for (rootdir, dirs, files) in _walk(root):
+        prefix = _relpath_prefix(rootdir)
         for f in files:
             if f.endswith('.html') or f.endswith('.txt'):
-                relpath = os.path.join(reldir, f)
-                yield os.path.normpath(relpath)
+                yield prefix + f
 
 
 def _graphie_label_files():
@@ -187,15 +314,13 @@ def _graphie_label_files():
     """
     with open(ka_root.join('intl', 'translations',
                            'graphie_image_shas.json')) as f:
-        for sha in json.load(f).keys():
-            yield os.path.join('genfiles', 'labels', 'en',
-                               '%s-data.json' % sha)
+        for sha in json.load(f):
+            yield _GRAPHIE_LABEL_FILE_PATTERN % sha
 
     with open(ka_root.join('intl', 'translations',
                            'graphie_image_shas_in_articles.json')) as f:
-        for sha in json.load(f).keys():
-            yield os.path.join('genfiles', 'labels', 'en',
-                               '%s-data.json' % sha)
+        for sha in json.load(f):
+            yield _GRAPHIE_LABEL_FILE_PATTERN % sha
 
 
 def _cse_files():
@@ -205,7 +330,13 @@ def _cse_files():
 
 
 def _merge_poentry(existing, new):
-    """Merge new into existing.  Sort occurrences, comments, and flags."""
+    """Merge new into existing.
+
+    We do not sort (or uniquify) occurrences, comments, and flags
+    here, since a common string can be merged thousands of times and
+    re-sorting each time is quadratic.  Instead, _write_pofile()
+    normalizes them once, via _normalize_poentry().
+    """
     # First make sure the msgid_plural are compatible.  They are if
     # they match, or one is None (meaning a string is used singular in
     # one place and plural in another).
@@ -225,24 +356,46 @@ def _merge_poentry(existing, new):
 
     if new.occurrences:
         existing.occurrences.extend(new.occurrences)
-        existing.occurrences = sorted(set(existing.occurrences),
-                                      key=lambda (f, lineno): (f, int(lineno)))
 
     if new.comment:
-        comments = existing.comment.split('\n') + new.comment.split('\n')
-        comments = sorted(set(c for c in comments if c))  # uniquify and sort
-        existing.comment = '\n'.join(comments)
+        # Appending to existing.comment would copy the whole string
+        # each time, so we collect the new comments in a list instead.
+        if not hasattr(existing, 'comments_to_merge'):
+            existing.comments_to_merge = []
+        existing.comments_to_merge.append(new.comment)
 
     if new.flags:
         existing.flags.extend(new.flags)
-        existing.flags = sorted(set(existing.flags))
 
 
-def _add_poentry(po_entries, filename, lineno, message, comments, context):
+def _normalize_poentry(entry):
+    """Uniquify and sort the occurrences, comments and flags of entry."""
+    entry.occurrences = sorted(set(entry.occurrences),
+                               key=lambda (f, lineno): (f, int(lineno)))
+
+    # Entries that were never merged keep their comment as-is, so
+    # multi-line comments keep their line order.
+    comments_to_merge = getattr(entry, 'comments_to_merge', None)
+    if comments_to_merge:
+        comments = entry.comment.split('\n')
+        for comment in comments_to_merge:
+            comments.extend(comment.split('\n'))
+        entry.comments_to_merge = []
+        entry.comment = '\n'.join(sorted(set(c for c in comments if c)))
+
+    entry.flags = sorted(set(entry.flags))
+
+
+def _add_poentry(po_entries, ordered_po_entries, filename, lineno, message,
+                 comments, context):
     """Turn the output as returned from babel.extract into a polib entry.
 
     Arguments:
         po_entries: a map from po_entry.msgid -> poentry
+        ordered_po_entries: the values of po_entries, in the order
+            they were added.  We keep this separately, rather than
+            using an OrderedDict, because OrderedDict is pure python
+            and slow to insert into.
         filename: where we are extracting nltext strings from, relative
             to ka-root.
         (rest): as returned from babel.messages.extract.extract_from_file()
@@ -260,6 +413,15 @@ def _add_poentry(po_entries, filename, lineno, message, comments, context):
     if '%(' in msgid or '%(' in (msgid_plural or ''):
         flags.append('python-format')
 
+    # Uniquify and sort the comments.  We strip each comment only
+    # once, and most strings have no comments at all.
+    if comments:
+        comments = set(c.strip() for c in comments)
+        comments.discard('')
+        comment = '\n'.join(sorted(comments))
+    else:
+        comment = ''
+
     new_poentry = polib.POEntry(
         msgid=msgid,
         msgid_plural=msgid_plural,
@@ -267,25 +429,37 @@ def _add_poentry(po_entries, filename, lineno, message, comments, context):
         msgstr_plural=msgstr_plural,
         occurrences=[(filename, str(lineno))],
         msgctxt=context,
-        comment='\n'.join(sorted(set(c.strip() for c in comments
-                                     if c.strip()))),
+        comment=comment,
         flags=flags)
 
-    if new_poentry.msgid in po_entries:
-        old_poentry = po_entries[new_poentry.msgid]
+    old_poentry = po_entries.get(new_poentry.msgid)
+    if old_poentry is not None:
         _merge_poentry(old_poentry, new_poentry)
     else:
         po_entries[new_poentry.msgid] = new_poentry
+        ordered_po_entries.append(new_poentry)
+
 
+def _pofile_sort_key(entry):
+    """The key used to sort po-entries in _write_pofile()."""
+    # Most comments don't have urls in them, so we avoid the regexp
+    # when we can.
+    urls = _URL_RE.findall(entry.comment) if '<http' in entry.comment else []
+    first_url = min(urls) if urls else ''
+    return (entry.occurrences[0][0], int(entry.occurrences[0][1]), first_url)
 
-def _write_pofile(po_entries, filename, write_debug_file_to=None):
-    """Write a polib.POFile to filename.
+
+def _write_pofile(po_entries, filename):
+    """Write a list of po-entries to filename.
 
     The po-file format is nicely human-readable, but slow to parse.
     The mo-file format is faster to parse, but loses important
-    information.  So we introduce a *third* format: pickled
-    polib.POFile.  Whenever we save a pofile to disk, we save a
-    pickled form of the python data structure (polib.POFile).
+    information.  So we introduce a *third* format: a marshalled
+    list of tuples, one per polib.POEntry, holding just the fields we
+    care about (see _POENTRY_FIELDS).  This is much faster to write
+    and read than pickling the polib.POFile itself, since pickle has
+    to walk the object graph of every POEntry.  Any other POEntry
+    fields (tcomment, obsolete, previous_msgid, etc.) are not saved.
 
     We also normalize the po-entries before writing the file, to
     minimize diffs.
@@ -293,13 +467,12 @@ def _write_pofile(po_entries, filename, write_debug_file_to=None):
     Arguments:
        po_entries: a list of of POEntry objects.
        filename: an absolute path to write the pofile to.
-       write_debug_file_to: if not None, a filename to write the po_entries
-          as a (human-readable) po-file, rather than a po.pickle file.
     """
-    from intl import polib_util
-
-    output_pot = polib_util.pofile()
-    output_pot.extend(po_entries)
+    # We only need a real polib.POFile for the debug file (see
+    # _write_debug_pofile()); here, a plain list is enough.
+    output_entries = list(po_entries)
+    for entry in output_entries:
+        _normalize_poentry(entry)
 
     # sort the po-entries in a canonical order, to make diff-ing
     # easier, but that tries to keep content close together in the
@@ -311,88 +484,172 @@ def _write_pofile(po_entries, filename, write_debug_file_to=None):
     # things, we depend on the fact python's sorts are stable to
     # keep them in input order (that is, the order that we extracted
     # them from the input ifle).
-    url_re = re.compile('<http[^>]*>')
-    output_pot.sort(key=lambda e: (e.occurrences[0][0],
-                                   int(e.occurrences[0][1]),
-                                   sorted(url_re.findall(e.comment))[:1]))
+    output_entries.sort(key=_pofile_sort_key)
 
-    log.v2('Writing to %s', filename)
-    with open(filename, 'w') as f:
-        cPickle.dump(output_pot, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    # We serialize to a string and then write it all at once, rather
+    # than having marshal make lots of small writes to the file.  We
+    # free the flattened entries as soon as we can, to keep peak
+    # memory down when writing all.pot.
+    flattened_entries = [tuple(getattr(e, field) for field in _POENTRY_FIELDS)
+                         for e in output_entries]
+    serialized_entries = marshal.dumps(flattened_entries, _MARSHAL_VERSION)
+    del flattened_entries
 
-    if write_debug_file_to:
-        log.v2('Also writing to %s', write_debug_file_to)
-        with open(write_debug_file_to, 'w') as f:
-            polib_util.write_pofile(output_pot, f)
+    log.v2('Writing to %s', filename)
+    with open(filename, 'wb') as f:
+        f.write(serialized_entries)
+    del serialized_entries
 
     log.v3('Done!')
 
 
+def _write_debug_pofile(po_entries, filename):
+    """Write po_entries to filename as a (human-readable) po-file.
+
+    This is much slower than _write_pofile(), so we only do it when
+    someone asks for the debug file.  po_entries should be as
+    returned by _read_pofile(), so they are already normalized.
+    """
+    from intl import polib_util
+
+    log.v2('Writing to %s', filename)
+    with open(filename, 'w', _DEBUG_FILE_BUFFER_SIZE) as f:
+        polib_util.write_pofile(po_entries, f)
+
+
 def _read_pofile(filename):
-    """Read from filename, a pickled polib.POFile, and return it."""
+    """Read from filename, as written by _write_pofile, and return it.
+
+    The return value is a polib.POFile, whose entries only have the
+    fields in _POENTRY_FIELDS set, or None if filename does not exist.
+    """
+    from intl import polib_util
+
     log.v2('Reading from %s', filename)
     try:
-        with open(filename) as f:
-            return cPickle.load(f)
+        with open(filename, 'rb') as f:
+            contents = f.read()
     except (IOError, OSError):
         return None
+    flattened_entries = marshal.loads(contents)
+    pofile = polib_util.pofile()
+    pofile.extend(polib.POEntry(**dict(zip(_POENTRY_FIELDS, e)))
+                  for e in flattened_entries)
+    return pofile
 
 
-class ExtractStrings(compile_rule.CompileBase):
-    def version(self):
-        """Update every time build() changes in a way that affects output."""
-        return 4
+def _import_babel():
+    """Import babel.  Used to initialize sub-processes that extract strings."""
+    # We import here so the kake system doesn't require these
+    # imports unless they're actually used.
+    import third_party.babel.messages.extract
+    return third_party.babel.messages.extract
 
-    def build(self, outfile_name, infile_names, changed, context):
-        # We import here so the kake system doesn't require these
-        # imports unless they're actually used.
-        import third_party.babel.messages.extract
 
-        assert len(infile_names) == 1, infile_names
+def _extract_strings(infile_name_and_abspaths):
+    """Extract the nltext strings from one file and write them as a pofile.
 
-        keywords = third_party.babel.messages.extract.DEFAULT_KEYWORDS.copy()
-        keywords['_js'] = keywords['_']           # treat _js() like _()
-        # <$_> in jsx expands to $_({varmap}, "string", ...), so kw-index is 2.
-        keywords['$_'] = (2,)                     # used in .jsx files as <$_>
-        keywords['mark_for_translation'] = None   # used in .py files
-        keywords['cached_gettext'] = keywords['gettext']  # used in .py files
-        keywords['cached_ngettext'] = keywords['ngettext']  # used in .py files
+    Arguments:
+        infile_name_and_abspaths: a triple: the file to extract
+            strings from, relative to ka-root; its absolute path; and
+            the absolute path of the pofile to write.  (We take a
+            single argument so this can be used with Pool.map().)
+    """
+    (infile_name, abs_infile_name, abs_outfile_name) = infile_name_and_abspaths
+    babel_extract = _import_babel()
+
+    keywords = babel_extract.DEFAULT_KEYWORDS.copy()
+    keywords['_js'] = keywords['_']           # treat _js() like _()
+    # <$_> in jsx expands to $_({varmap}, "string", ...), so kw-index is 2.
+    keywords['$_'] = (2,)                     # used in .jsx files as <$_>
+    keywords['mark_for_translation'] = None   # used in .py files
+    keywords['cached_gettext'] = keywords['gettext']  # used in .py files
+    keywords['cached_ngettext'] = keywords['ngettext']  # used in .py files
+
+    comment_tags = ['I18N:']
+
+    options = {'newstyle_gettext': 'true',    # used by jinja/ext.py
+               'encoding': 'utf-8'}           # used by jinja/ext.py
+
+    extractor = _extractor(infile_name)       # fn extracting strings
+    log.v3('Extracting from %s (via %s)' % (infile_name, extractor))
+
+    with open(abs_infile_name) as fileobj:
+        # babel's python and javascript tokenizers are slow, and
+        # most source files have nothing to translate, so we do a
+        # quick check first to see if we can skip babel entirely.
+        if (extractor in _TOKENIZING_EXTRACTORS and
+                not _may_call_keywords(fileobj.read(),
+                                       _keyword_call_re(keywords))):
+            log.v3('Skipping %s: no translation keywords found' % infile_name)
+            nltext_data = []
+        else:
+            fileobj.seek(0)
+            nltext_data = babel_extract.extract(
+                extractor, fileobj,
+                keywords=keywords, comment_tags=comment_tags,
+                options=options, strip_comment_tags=True)
 
-        comment_tags = ['I18N:']
+        # Create 'pseudo' polib entries, with sets instead of lists to
+        # make merging easier.  We'll convert to real polib entries later.
+        # The order matters: _write_pofile() keeps entries that
+        # sort the same in the order we add them.
+        po_entries = {}
+        ordered_po_entries = []
+        for (lineno, message, comments, context) in nltext_data:
+            _add_poentry(po_entries, ordered_po_entries, infile_name,
+                         lineno, message, comments, context)
 
-        options = {'newstyle_gettext': 'true',    # used by jinja/ext.py
-                   'encoding': 'utf-8'}           # used by jinja/ext.py
+    # This turns the 'pseudo' polib entries back into real polib
+    # entries and writes them as a marshalled pofile to disk.
+    _write_pofile(ordered_po_entries, abs_outfile_name)
 
-        extractor = _extractor(infile_names[0])    # fn extracting strings
-        log.v3('Extracting from %s (via %s)' % (infile_names[0], extractor))
 
-        with open(self.abspath(infile_names[0])) as fileobj:
-            nltext_data = third_party.babel.messages.extract.extract(
-                extractor, fileobj,
-                keywords=keywords, comment_tags=comment_tags, options=options,
-                strip_comment_tags=True)
+class ExtractStrings(compile_rule.CompileBase):
+    """Extract strings from each file into its own pofile.
+
+    Extraction is cpu-bound (babel's tokenizers are pure python), so
+    we want to extract files in parallel.  When kake is building with
+    several processes, split_outputs() gives each process its share of
+    the files.  When kake is building with just one process, we get
+    all the files at once, and build_many() extracts them in a pool
+    of sub-processes itself.
+    """
+    def version(self):
+        """Update every time build() changes in a way that affects output."""
+        return 7
 
-            # Create 'pseudo' polib entries, with sets instead of lists to
-            # make merging easier.  We'll convert to real polib entries later.
-            po_entries = collections.OrderedDict()
-            for (lineno, message, comments, context) in nltext_data:
-                _add_poentry(po_entries, infile_names[0],
-                             lineno, message, comments, context)
+    def build_many(self, outfile_infiles_changed_context):
+        extract_args = []
+        for (outfile_name, infile_names, _, _) in (
+                outfile_infiles_changed_context):
+            assert len(infile_names) == 1, infile_names
+            extract_args.append((infile_names[0],
+                                 self.abspath(infile_names[0]),
+                                 self.abspath(outfile_name)))
 
-        # This turns the 'pseudo' polib entries back into real polib
-        # entries and writes them as a pickled pofile to disk.
-        _write_pofile(po_entries.itervalues(), self.abspath(outfile_name))
+        compile_util.map_in_subprocesses(_extract_strings, extract_args,
+                                         _MIN_FILES_FOR_PARALLEL_EXTRACT,
+                                         initializer=_import_babel)
+
+    def split_outputs(self, outfile_infiles_changed_context, num_processes):
+        """Split extractions into one chunk per process."""
+        return compile_util.split_outputs_evenly(
+            outfile_infiles_changed_context, num_processes)
 
 
 class CombinePOTFiles(compile_rule.CompileBase):
     def version(self):
         """Update every time build() changes in a way that affects output."""
-        return 1
+        return 4
 
     def build(self, outfile_name, infile_names, changed, context):
         # The infiles here are genfiles/extracted_string/foo.pot.pickle
         # Copy unchanged messages from the existing all.pot, if possible.
-        po_entries = collections.OrderedDict()
+        # As in ExtractStrings, we keep track of the order we see
+        # msgids in separately from the msgid -> poentry map.
+        po_entries = {}
+        ordered_po_entries = []
         if outfile_name in changed or changed == infile_names:
             log.v1('Regenerating %s from scratch (it changed on us!)'
                    % outfile_name)
@@ -408,18 +665,28 @@ class CombinePOTFiles(compile_rule.CompileBase):
                 # now.  (They'll be removed from all.pot by default.)
                 # Get rid of them from 'changed' so they don't gum up
                 # the code below.
-                changed = [f for f in changed if f in infile_names]
+                infile_set = set(infile_names)
+                changed = [f for f in changed if f in infile_set]
 
                 # Elements in infile_names and changed look like
                 # 'genfiles/extracted_strings/en/foo.pot.pickle'. Here,
                 # we want the version of infiles/changed that are just
                 # 'foo'.  We use the _input_map to get that mapping.
-                orig_infiles = set(context['_input_map'][f][0]
-                                   for f in infile_names)
-                # f might not be in _input_map if it's ben deleted.
-                orig_changed = set(context['_input_map'][f][0]
-                                   for f in changed)
-                unchanged = orig_infiles - orig_changed
+                # We do it in a single pass over the infiles, since
+                # 'changed' is a subset of them.
+                input_map = context['_input_map']
+                changed_set = set(changed)
+                unchanged = set()
+                orig_changed = set()
+                for f in infile_set:
+                    orig_infile = input_map[f][0]
+                    if f in changed_set:
+                        orig_changed.add(orig_infile)
+                    else:
+                        unchanged.add(orig_infile)
+                # Two pot files could come from the same original
+                # file; if either changed, we treat the file as changed.
+                unchanged -= orig_changed
                 for entry in existing_all_pot:
                     # Get rid of occurrences for files that no longer exist.
                     # TODO(csilvers): get rid of comments in the same way.
@@ -428,6 +695,7 @@ class CombinePOTFiles(compile_rule.CompileBase):
                     # If the msgid still exists at all, let's keep it!
                     if entry.occurrences:
                         po_entries[entry.msgid] = entry
+                        ordered_po_entries.append(entry)
             else:
                 changed = infile_names
 
@@ -435,25 +703,26 @@ class CombinePOTFiles(compile_rule.CompileBase):
         for filename in changed:
             input_pot = _read_pofile(self.abspath(filename))
             for poentry in input_pot:
-                if poentry.msgid in po_entries:
-                    existing_poentry = po_entries[poentry.msgid]
+                existing_poentry = po_entries.get(poentry.msgid)
+                if existing_poentry is not None:
                     _merge_poentry(existing_poentry, poentry)
                 else:
                     po_entries[poentry.msgid] = poentry
+                    ordered_po_entries.append(poentry)
 
         log.v2('Writing merged output')
-        _write_pofile(po_entries.itervalues(), self.abspath(outfile_name),
-                      write_debug_file_to=self.abspath(outfile_name.replace(
-                          '.pickle', '.txt_for_debugging')))
+        _write_pofile(ordered_po_entries, self.abspath(outfile_name))
 
 
-class NullRule(compile_rule.CompileBase):
+class WriteDebugPOTFile(compile_rule.CompileBase):
     def version(self):
         """Update every time build() changes in a way that affects output."""
         return 1
 
     def build(self, outfile_name, infile_names, changed, context):
-        pass
+        assert len(infile_names) == 1, infile_names
+        po_entries = _read_pofile(self.abspath(infile_names[0]))
+        _write_debug_pofile(po_entries, self.abspath(outfile_name))
 
 
 class ComputePotInputs(computed_inputs.ComputedInputsBase):
@@ -462,7 +731,7 @@ class ComputePotInputs(computed_inputs.ComputedInputsBase):
         return 1
 
     def _skip_files_from_app_yaml(self):
-        return re.compile('^.*_test\..*$')
+        return _SKIP_TEST_FILES_RE
 
     def input_patterns(self, outfile_name, context, triggers, changed):
         import intl.english_only
@@ -486,12 +755,15 @@ class ComputePotInputs(computed_inputs.ComputedInputsBase):
         candidates.add(_MANUAL_TRANSLATION_CSV_FILE)
 
         # Ignore files we know we don't care about translating: those
-        # that english_only.py says not to translate, and files that
-        # app.yaml says to skip even for dev_appserver.
+        # that app.yaml says to skip even for dev_appserver, and
+        # those that english_only.py says not to translate.  We do
+        # the (cheap) regexp check first so we only need to call
+        # should_not_translate_file() on files that pass it.
         skip_files_re = self._skip_files_from_app_yaml()
+        should_not_translate_file = intl.english_only.should_not_translate_file
         candidates = set(f for f in candidates
-                         if (not intl.english_only.should_not_translate_file(f)
-                             and not skip_files_re.match(f)))
+                         if (not skip_files_re.match(f) and
+                             not should_not_translate_file(f)))
 
         # Finally, we're not interested in the files themselves,
         # we're interested in the .pot files that hold the extracted
@@ -508,7 +780,6 @@ compile_rule.register_compile(
     ExtractStrings())
 
 # The rule to combine all the per-file .pot files into all.pot.
-# This also generates all.pot.txt_for_debugging, which is human-readable.
 compile_rule.register_compile(
     'ALL.POT',
     'genfiles/translations/all.pot.pickle',
@@ -516,9 +787,10 @@ compile_rule.register_compile(
     CombinePOTFiles())
 
 # This is used only for testing and debugging: get the all.pot.pickle
-# file into a more readable format.
+# file into a more readable format.  Writing this is slow, so we only
+# do it when someone asks for it.
 compile_rule.register_compile(
     'ALL.POT FOR DEBUGGING',
     'genfiles/translations/all.pot.txt_for_debugging',
     ['genfiles/translations/all.pot.pickle'],
-    NullRule())    # all.pot.pickle creates the debugging file automatically
+    WriteDebugPOTFile())
@@ -4,8 +4,11 @@
 
 from __future__ import absolute_import
 
+import atexit
 import json
 import os
+import shutil
+import tempfile
 
 import mock
 from shared.testutil import testsize
@@ -24,7 +27,35 @@ _GRAPHIE_DATA = r'''svgData110f132aaa8a4e2aed4655088a99552715a1177f(
     "alignment":"center","typesetAsMath":true,"style":{"color":"black"}}]});'''
 
 
+# The contents of the graphie-image-sha files that setUp() writes.
+_GRAPHIE_SHAS_JSON = json.dumps({
+    "110f132aaa8a4e2aed4655088a99552715a1177f": {
+        "itemId": "xc1b25120",
+        "exerciseSlug": "number-opposites"}
+})
+_GRAPHIE_SHAS_IN_ARTICLES_JSON = json.dumps({
+    "110f132aaa8a4e2aed4655088a99552715a1177f": "number-article"
+})
+
+
+def _size_and_mtime(filename):
+    s = os.lstat(filename)
+    return (s.st_size, s.st_mtime)
+
+
 class TestBase(testutil.KakeTestBase):
+    # Every test starts with the same files, so we create them in the
+    # first test's tmpdir, save a copy of that tmpdir here, and just
+    # hard-link that copy into the tmpdir of every later test.  This
+    # means tests must never modify these files in place!  tearDown()
+    # checks for that, using the (size, mtime) of each template file.
+    _template_dir = None
+    _template_file_info = None
+
+    # The files and dirs, relative to the tmpdir, that a test class
+    # needs from the template, or None to use all of them.
+    _TEST_FILES = None
+
     def setUp(self, *args, **kwargs):
         super(TestBase, self).setUp(*args, **kwargs)   # creates self.tmpdir
 
@@ -32,6 +63,51 @@ class TestBase(testutil.KakeTestBase):
         # TODO(csilvers): figure out how to test this functionality too.
         self.mock_value('kake.compile_all_pot._DATASTORE_FILE', None)
 
+        if TestBase._template_dir is None:
+            self._create_test_files()
+            template_dir = tempfile.mkdtemp(
+                prefix='compile_all_pot_test_template.',
+                dir=os.path.dirname(self.tmpdir))
+            os.rmdir(template_dir)     # copytree wants to create it
+            shutil.copytree(self.tmpdir, template_dir, symlinks=True)
+            atexit.register(shutil.rmtree, template_dir, True)
+            TestBase._template_dir = template_dir
+
+            # We do the same for the graphie data urlretrieve gives us.
+            with open(template_dir + '.graphie_data', 'wb') as f:
+                f.write(_GRAPHIE_DATA)
+            atexit.register(os.unlink, template_dir + '.graphie_data')
+            template_files = [template_dir + '.graphie_data']
+            for (root, _, files) in os.walk(template_dir):
+                template_files.extend(os.path.join(root, f) for f in files)
+            TestBase._template_file_info = {f: _size_and_mtime(f)
+                                            for f in template_files}
+        else:
+            self._link_test_files(TestBase._template_dir)
+
+        def mock_url_retrieve(url, outfile_name):
+            self._link_test_file(TestBase._template_dir + '.graphie_data',
+                                 self._abspath(outfile_name))
+
+        self.mock_function('urllib.urlretrieve', mock_url_retrieve)
+
+        # A convenience var
+        self.all_pot = self._abspath('genfiles', 'translations',
+                                     'all.pot.txt_for_debugging')
+
+    def tearDown(self):
+        # Our test files are hard links to the template's, so a rule
+        # that wrote to one in place would break every later test.
+        changed = [f for (f, size_and_mtime)
+                   in TestBase._template_file_info.iteritems()
+                   if _size_and_mtime(f) != size_and_mtime]
+        if changed:
+            TestBase._template_dir = None    # make a fresh one next time
+        super(TestBase, self).tearDown()
+        self.assertEqual([], changed,
+                         'Test modified hard-linked template files in place')
+
+    def _create_test_files(self):
         # Copy over all the files from compile_all_pot-testfiles/,
         # to create our new mini-webapp repo.
         self._copy_to_test_tmpdir(os.path.join('kake',
@@ -40,42 +116,64 @@ class TestBase(testutil.KakeTestBase):
         # Write a graphie image sha list with just one item
         os.makedirs(self._abspath('intl', 'translations'))
         with open(self._abspath('intl', 'translations',
-                                'graphie_image_shas.json'), 'w') as f:
-            json.dump({
-                "110f132aaa8a4e2aed4655088a99552715a1177f": {
-                    "itemId": "xc1b25120",
-                    "exerciseSlug": "number-opposites"}
-            }, f)
+                                'graphie_image_shas.json'), 'wb') as f:
+            f.write(_GRAPHIE_SHAS_JSON)
 
         # Write a graphie image sha for articles list with just one item
         with open(self._abspath('intl', 'translations',
-                'graphie_image_shas_in_articles.json'), 'w') as f:
-            json.dump({
-                "110f132aaa8a4e2aed4655088a99552715a1177f": "number-article"
-            }, f)
+                'graphie_image_shas_in_articles.json'), 'wb') as f:
+            f.write(_GRAPHIE_SHAS_IN_ARTICLES_JSON)
 
         # Write the CSE config files.
         os.makedirs(self._abspath('search'))
-        with open(self._abspath('search', 'cse.xml'), 'w') as f:
-            print >>f, '<xml><cse></cse></xml>'
-        with open(self._abspath('search', 'annotations.xml'), 'w') as f:
-            print >>f, '<xml><annotations></annotations></xml>'
-
-        def mock_url_retrieve(url, outfile_name):
-            with open(self._abspath(outfile_name), 'w') as f:
-                f.write(_GRAPHIE_DATA)
-
-        self.mock_function('urllib.urlretrieve', mock_url_retrieve)
+        with open(self._abspath('search', 'cse.xml'), 'wb') as f:
+            f.write('<xml><cse></cse></xml>\n')
+        with open(self._abspath('search', 'annotations.xml'), 'wb') as f:
+            f.write('<xml><annotations></annotations></xml>\n')
 
         # Also copy app.yaml, so we can do proper ignoring
         self._copy_to_test_tmpdir('app.yaml')
 
         os.makedirs(self._abspath('genfiles', 'translations'))
-        # A convenience var
-        self.all_pot = self._abspath('genfiles', 'translations',
-                                     'all.pot.txt_for_debugging')
 
-    def _build(self, files_to_include, changed_files=None):
+    def _link_test_files(self, template_dir):
+        """Recreate template_dir in our tmpdir, using hard links."""
+        if self._TEST_FILES is not None:
+            for relpath in self._TEST_FILES:
+                source = os.path.join(template_dir, relpath)
+                target = self._abspath(relpath)
+                if os.path.isdir(source):
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                elif os.path.lexists(source):
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    self._link_test_file(source, target)
+            return
+
+        for (root, dirs, files) in os.walk(template_dir):
+            reldir = os.path.relpath(root, template_dir)
+            for d in dirs:
+                target = self._abspath(reldir, d)
+                if os.path.islink(os.path.join(root, d)):
+                    os.symlink(os.readlink(os.path.join(root, d)), target)
+                elif not os.path.isdir(target):
+                    os.mkdir(target)
+            for f in files:
+                self._link_test_file(os.path.join(root, f),
+                                     self._abspath(reldir, f))
+
+    def _link_test_file(self, source, target):
+        # The superclass setUp() makes some files, like app.yaml.
+        if os.path.lexists(target):
+            os.unlink(target)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+        else:
+            os.link(source, target)
+
+    def _build(self, files_to_include, changed_files=None,
+               build_debug_file=True):
         """Changed-files of none means *all* files to include are changed."""
         # First we have to build the individual .pot files.
         pot_files_to_include = [
@@ -95,6 +193,22 @@ class TestBase(testutil.KakeTestBase):
         pickle_compiler.build(pickle_file, pot_files_to_include,
                               pot_changed_files, {'_input_map': input_map})
 
+        # And then the human-readable version, which most tests look at.
+        if build_debug_file:
+            debug_compiler = compile_all_pot.WriteDebugPOTFile()
+            debug_file = 'genfiles/translations/all.pot.txt_for_debugging'
+            debug_compiler.build(debug_file, [pickle_file], [pickle_file], {})
+
+
+class TinyTestBase(TestBase):
+    """For tests that only look at a few files, so need only those."""
+    _TEST_FILES = ('app.yaml',
+                   'intl/manual.json',
+                   'intl/manual.csv',
+                   'javascript/j1.js',
+                   'webapp/main.rs',
+                   'genfiles/translations')
+
 
 class TestIncludingAndIgnoring(TestBase):
     def test_make(self):
@@ -352,7 +466,7 @@ class TestFlags(TestBase):
 
 
 @testsize.tiny
-class TestManualJson(TestBase):
+class TestManualJson(TinyTestBase):
     def test_entries_and_comments(self):
         self._build(['intl/manual.json'])
         self.assertFile(
@@ -377,7 +491,7 @@ class TestManualJson(TestBase):
 
 
 @testsize.tiny
-class TestManualCsv(TestBase):
+class TestManualCsv(TinyTestBase):
     def test_entries_and_comments(self):
         self._build(['intl/manual.csv'])
         self.assertFile(
@@ -402,7 +516,7 @@ class TestManualCsv(TestBase):
 
 
 @testsize.tiny
-class TestLoadingAndSaving(TestBase):
+class TestLoadingAndSaving(TinyTestBase):
     def setUp(self, *args, **kwargs):
         super(TestLoadingAndSaving, self).setUp(*args, **kwargs)
         self.all_pot_pickle = self.all_pot.replace('.txt_for_debugging',
@@ -411,7 +525,7 @@ class TestLoadingAndSaving(TestBase):
     def test_load_non_existing_all_pot(self):
         # We expect no logline because we're regenerating from scratch.
         with mock.patch('kake.lib.log.v2') as logger:
-            self._build(['intl/manual.json'])
+            self._build(['intl/manual.json'], build_debug_file=False)
             self.assertNotIn(
                 mock.call('Reading from %s', self.all_pot_pickle),
                 logger.call_args_list)
@@ -423,7 +537,8 @@ class TestLoadingAndSaving(TestBase):
         # We expect no logline because we're doing a total rebuild.
         self._build(['intl/manual.json', 'javascript/j1.js'])
         with mock.patch('kake.lib.log.v2') as logger:
-            self._build(['intl/manual.json', 'javascript/j1.js'])
+            self._build(['intl/manual.json', 'javascript/j1.js'],
+                        build_debug_file=False)
             self.assertNotIn(
                 mock.call('Reading from %s', self.all_pot_pickle),
                 logger.call_args_list)
@@ -442,7 +557,7 @@ class TestLoadingAndSaving(TestBase):
 
 
 @testsize.tiny
-class TestInvalidFileType(TestBase):
+class TestInvalidFileType(TinyTestBase):
     def test_invalid_file_type(self):
         with self.assertRaises(compile_rule.BadRequestFailure):
             self._build(['webapp/main.rs'])
@@ -4,39 +4,99 @@
 
 from __future__ import absolute_import
 
+import json
+import os
+import sys
+
 from kake.lib import compile_rule
+from kake.lib import compile_util
+
+# The browsers autoprefixer should add prefixes for.  If you change
+# this, update CompileAutoprefixedCss.version().
+# TODO(nick): autoprefixer params should be passed in dynamically
+# Settings for autoprefixer:
+# https://github.com/postcss/autoprefixer#options
+_BROWSERS = 'IE >= 10, IOS >= 8'
 
 
 class CompileAutoprefixedCss(compile_rule.CompileBase):
     def version(self):
         """Update every time build() changes in a way that affects output."""
-        return 2
+        return 4
+
+    def build_many(self, output_inputs_changed_context):
+        driver = None
+        cache = None
+        autoprefix_args = []
+        cache_keys = []
+        for (output, inputs, _, context) in output_inputs_changed_context:
+            # infile, autoprefixer's and postcss's package.json, and
+            # our driver script
+            assert len(inputs) == 4, inputs
+            assert 'run_autoprefixer.js' in inputs[3]
+            if driver is None:
+                driver = inputs[3]
+                # Starting up autoprefixer is slow, so we reuse its
+                # output if we've seen this input before.
+                cache = compile_util.ContentCache(
+                    'autoprefixed_css', inputs[1:], self.version())
+            else:
+                assert driver == inputs[3], (
+                    'All css files must use the same autoprefixer driver')
+
+            key = cache.key(inputs[0])
+            if cache.get(key, output):
+                # The css may not have had a sourcemap; if so, don't
+                # leave an out-of-date one around from an earlier build.
+                if (not cache.get(key, output + '.map', suffix='.map') and
+                        os.path.exists(self.abspath(output + '.map'))):
+                    os.unlink(self.abspath(output + '.map'))
+            else:
+                autoprefix_args.append((inputs[0], output))
+                cache_keys.append((key, output))
+
+        # Save our inputs' fingerprints so we needn't re-read them
+        # next time.
+        compile_util.ContentCache.sync()
+
+        if autoprefix_args:
+            (retcode, stdout, stderr) = self.try_call_with_input(
+                ['node', driver],
+                input=json.dumps({'browsers': _BROWSERS,
+                                  'files': autoprefix_args}))
+            if retcode != 0:
+                raise compile_rule.CompileFailure(
+                    'Autoprefixing %s failed:\n%s\n'
+                    % ([x[0] for x in autoprefix_args], stderr))
 
-    def build(self, outfile_name, infile_names, _, context):
-        # infile and autoprefixer binary
-        assert len(infile_names) == 2, infile_names
-        # TODO(nick): autoprefixer params should be passed in dynamically
-        browser_option = "--browsers"
-        browser_option_value = "IE >= 10, IOS >= 8"
+            # We store the sourcemap first so it's in the cache
+            # whenever the css is.
+            for (key, output) in cache_keys:
+                if os.path.exists(self.abspath(output + '.map')):
+                    cache.put(key, output + '.map', suffix='.map')
+                cache.put(key, output)
 
-        self.call(
-            # infile_names[1] is the autoprefixer binary
-            # Settings for autoprefixer:
-            # https://github.com/postcss/autoprefixer#options
-            [infile_names[1], '-o', outfile_name, browser_option,
-            browser_option_value, '--map', infile_names[0]])
+    def num_outputs(self):
+        """stdin can take as much data as we can throw at it!"""
+        return sys.maxint
 
 
+# We have to list the dependencies on node_modules explicitly; we can't
+# magically parse them from the require calls in run_autoprefixer.js.
 compile_rule.register_compile(
     'AUTOPREFIXED CSS',
     'genfiles/compiled_autoprefixed_css/en/{{path}}.css',
     ['{{path}}.css',
-     'genfiles/node_modules/.bin/autoprefixer'],
+     'genfiles/node_modules/autoprefixer/package.json',
+     'genfiles/node_modules/postcss/package.json',
+     'kake/run_autoprefixer.js'],
     CompileAutoprefixedCss())
 
 compile_rule.register_compile(
     'AUTOPREFIXED LESS.CSS',
     'genfiles/compiled_autoprefixed_css/en/{{path}}.less.css',
     ['genfiles/compiled_less/en/{{path}}.less.css',
-     'genfiles/node_modules/.bin/autoprefixer'],
+     'genfiles/node_modules/autoprefixer/package.json',
+     'genfiles/node_modules/postcss/package.json',
+     'kake/run_autoprefixer.js'],
     CompileAutoprefixedCss())
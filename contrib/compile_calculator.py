@@ -6,6 +6,9 @@ We have to do that compilation here, and also add a footer.
 
 from __future__ import absolute_import
 
+import mmap
+import os
+
 from kake.lib import compile_rule
 
 
@@ -22,10 +25,20 @@ class CompileCalculator(compile_rule.CompileBase):
                    self.abspath(infile_names[0]),
                    '-o', self.abspath(outfile_name)])
         # The rest of the infile-names are just appended to the outfile.
-        with open(self.abspath(outfile_name), 'a') as f:
+        # We mmap the files so they go straight from the page cache
+        # to the outfile, rather than through a python string.
+        with open(self.abspath(outfile_name), 'ab') as f:
             for copy_from in infile_names[2:]:
-                with open(self.abspath(copy_from)) as f2:
-                    f.write(f2.read())
+                with open(self.abspath(copy_from), 'rb') as f2:
+                    size = os.fstat(f2.fileno()).st_size
+                    if size == 0:       # mmap doesn't support empty files
+                        continue
+                    contents = mmap.mmap(f2.fileno(), size,
+                                         access=mmap.ACCESS_READ)
+                    try:
+                        f.write(contents)
+                    finally:
+                        contents.close()
 
 
 compile_rule.register_compile(
@@ -16,12 +16,17 @@ es5.
 
 from __future__ import absolute_import
 
+import atexit
 import json
 import os
 import shutil
+import subprocess
 import sys
 
 from kake.lib import compile_rule
+from kake.lib import compile_util
+from kake.lib import log
+from kake.lib import project_root
 
 # We skip compiling this files because they've already been compiled when
 # `make subperseus` was run in the perseus project.  It saves some time during
@@ -42,6 +47,81 @@ _SKIP_COMPILATION = frozenset([
 ])
 
 
+def _clone(src, dst):
+    """Make dst have the same contents as src, hard-linking if we can.
+
+    We remove dst first so we never write through an old link to src.
+    """
+    try:
+        os.unlink(dst)
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:    # cross-device link, filesystem without links, etc.
+        shutil.copyfile(src, dst)
+
+
+class _Es6Worker(object):
+    """A long-lived `node compile_js.js --server` process.
+
+    Starting node and loading babel takes much of a second, so we
+    start one worker per compiler and reuse it for every build_many()
+    call in this process.  See compile_js.js for the protocol.
+    """
+    _WORKERS = {}
+
+    @classmethod
+    def get(cls, compiler, env_files):
+        """Return a running worker for compiler, starting one if needed.
+
+        We start a new worker whenever one of env_files (which
+        should include the compiler) changes, or we have forked.
+        """
+        key = (os.getpid(),
+               tuple(os.path.getmtime(project_root.join(f))
+                     for f in env_files))
+        worker = cls._WORKERS.get(compiler)
+        if worker is None or worker.key != key or not worker.is_running():
+            if worker is not None and worker.key[0] == key[0]:
+                worker.close()
+            worker = cls(compiler, key)
+            cls._WORKERS[compiler] = worker
+        return worker
+
+    def __init__(self, compiler, key):
+        log.v3('Starting node worker for %s', compiler)
+        self.key = key
+        self._last_id = 0
+        self._proc = subprocess.Popen(['node', compiler, '--server'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      cwd=project_root.root,
+                                      close_fds=True)
+        atexit.register(self.close)
+
+    def is_running(self):
+        return self._proc.poll() is None
+
+    def compile(self, compile_args):
+        """Compile [(infile, outfile), ...]; return an error or None."""
+        self._last_id += 1
+        self._proc.stdin.write(json.dumps({'id': self._last_id,
+                                           'files': compile_args}) + '\n')
+        self._proc.stdin.flush()
+        response = self._proc.stdout.readline()
+        if not response:
+            return 'The node compiler exited unexpectedly'
+        response = json.loads(response)
+        assert response['id'] == self._last_id, (response, self._last_id)
+        return response.get('err')
+
+    def close(self):
+        if self.is_running():
+            self._proc.stdin.close()
+            self._proc.wait()
+
+
 class CompileES6(compile_rule.CompileBase):
     def version(self):
         """Update every time build() changes in a way that affects output."""
@@ -49,34 +129,61 @@ class CompileES6(compile_rule.CompileBase):
 
     def build_many(self, output_inputs_changed_context):
         compiler = None
+        env_files = None
+        cache = None
         compile_args = []
+        cache_keys = []
         for (output, inputs, _, context) in output_inputs_changed_context:
             assert len(inputs) == 3, inputs
             assert inputs[0].endswith(('.js', '.jsx'))
             assert 'compile_js.js' in inputs[1]
             if compiler is None:
                 compiler = inputs[1]
+                # Babel's output depends on the compiler and babel itself.
+                env_files = inputs[1:]
+                cache = compile_util.ContentCache('es6', env_files,
+                                                  self.version())
             else:
                 assert compiler == inputs[1], (
                     'All js files must use the same js compiler')
 
-            if os.path.basename(inputs[0]) in _SKIP_COMPILATION:
-                shutil.copyfile(self.abspath(inputs[0]), self.abspath(output))
-            else:
+            # This is os.path.basename(), but faster.
+            basename = inputs[0][inputs[0].rfind('/') + 1:]
+            if basename in _SKIP_COMPILATION:
+                # These can be several megabytes, so avoid copying them.
+                _clone(self.abspath(inputs[0]), self.abspath(output))
+                continue
+
+            # The output may be a hard link to the input if this file
+            # used to be skipped; make sure we don't write through it.
+            if os.path.exists(self.abspath(output)):
+                os.unlink(self.abspath(output))
+
+            # Babel is slow; don't run it if we've compiled these
+            # exact file contents before.
+            key = cache.key(inputs[0])
+            if not cache.get(key, output):
                 compile_args.append((self.abspath(inputs[0]),
                                      self.abspath(output)))
+                cache_keys.append((key, output))
+
+        # Save our inputs' fingerprints so we needn't re-read them
+        # next time.
+        compile_util.ContentCache.sync()
 
         if compile_args:
-            (retcode, stdout, stderr) = self.try_call_with_input(
-                ['node', compiler],
-                input=json.dumps(compile_args))
-            if retcode != 0:
+            worker = _Es6Worker.get(compiler, env_files)
+            error = worker.compile(compile_args)
+            if error is not None:
                 input_files = [x[1][0] for x in output_inputs_changed_context]
                 message = 'Compiling JS files %s failed:\n%s\n' % (
-                    input_files, stderr)
+                    input_files, error)
                 raise compile_rule.GracefulCompileFailure(
                         message,
-                        'console.error(%s);' % json.dumps(stderr))
+                        'console.error(%s);' % json.dumps(error))
+
+            for (key, output) in cache_keys:
+                cache.put(key, output)
 
     def num_outputs(self):
         """stdin can take as much data as we can throw at it!"""
@@ -3,16 +3,85 @@
 from __future__ import absolute_import
 
 import inspect
-import json
+import io
 import os
 import re
+import subprocess
 import sys
 import types
 
+try:
+    # ujson's encoder is in C, and much faster than python2's json.
+    # We only use it to talk to node, which doesn't care which we use.
+    import ujson as json
+except ImportError:
+    import json
+
 from kake.lib import compile_rule
+from kake.lib import compile_util
+from kake.lib import filemod_db
 from kake.lib import log
+from kake.lib import project_root
+
+# Compiling to python is cpu-bound (pybars is pure python), so we
+# compile in sub-processes if there are at least this many templates.
+_MIN_FILES_FOR_PARALLEL_COMPILE = 8
+
+# An entry in the handlebars_partials dict, given the package and the
+# template basename.
+_PARTIAL_LINE = ('    "{0}_{1}": '
+                 'lambda params, partials=None, helpers=None: '
+                 'handlebars_template("{0}", "{1}", params),\n')
+
+# Pybars doesn't handle {{else}} for some reason, so we rewrite it.
+_ELSE_RE = re.compile(r'{{\s*else\s*}}')
+
+# The pybars compiler is stateless between calls to compile(), so we
+# only need to construct it (and import pybars) once per process.
+_PYBARS_COMPILER = None
+
+
+def _pybars_compiler():
+    global _PYBARS_COMPILER
+    if _PYBARS_COMPILER is None:
+        import third_party.pybars
+        _PYBARS_COMPILER = third_party.pybars.Compiler()
+    return _PYBARS_COMPILER
+
+
+def _template_source(template):
+    """Return the python source of a pybars-compiled template, as utf-8.
+
+    pybars compiles each template into its own module holding just
+    that one function, and keeps the module source on the module's
+    __loader__.  Reading it from there saves inspect.getsource() from
+    going through linecache and re-tokenizing the module to find the
+    end of the function.
+    """
+    loader = template.func_globals.get('__loader__')
+    if loader is not None:
+        return loader.get_source(template.__module__)
+    return inspect.getsource(template)
+
+
+def _template_constants(template):
+    """Return the (string, nested-template) constants of a pybars template.
 
-_PACKAGE_NAME_RE = re.compile(r'([^%s]+)-package' % os.sep)
+    Each is a list of (name, value) pairs.  pybars stores the literal
+    text and nested blocks of a template as constant_<n> globals of
+    the compiled function, alongside a handful of helpers.  Every
+    nested template belongs to exactly one parent, so we only ever
+    need to look at each template's globals once.
+    """
+    string_constants = []
+    function_constants = []
+    for (name, val) in template.func_globals.iteritems():
+        if name.startswith("constant_"):
+            if isinstance(val, unicode):
+                string_constants.append((name, val))
+            elif isinstance(val, types.FunctionType):
+                function_constants.append((name, val))
+    return (string_constants, function_constants)
 
 
 def _extract_pkg_base_name_from_path(path):
@@ -25,25 +94,51 @@ def _extract_pkg_base_name_from_path(path):
     # TODO(jlfwong): Remove the concept of package names for handlebars
     # compilation/rendering completely. This will require rewriting every call
     # handlebars_template and every call to #invokePartial.
-    m = _PACKAGE_NAME_RE.search(path)
-    assert m, "Can't figure out the package for '%s'" % path
-    return (m.group(1) or m.group(2))
+    for part in path.split(os.sep):
+        if part.endswith('-package'):
+            return part[:-len('-package')]
+    raise AssertionError("Can't figure out the package for '%s'" % path)
+
+
+def _compile_to_python(infile_and_outfile_abspaths):
+    """Compile one template.  Takes one arg so it works with Pool.map()."""
+    CompilePyHandlebars()._compile_file_to_python(*infile_and_outfile_abspaths)
 
 
 class CompilePyHandlebars(compile_rule.CompileBase):
-    """Compiles .handlebars files to python code."""
+    """Compiles .handlebars files to python code.
+
+    Each template compiles independently, so as with ExtractStrings in
+    compile_all_pot.py, split_outputs() gives each of kake's build
+    processes its share of the templates, and when kake is building
+    with just one process, build_many() uses a pool of its own.
+    """
     def version(self):
         """Update every time build() changes in a way that affects output."""
-        return 3
-
-    def build(self, outfile_name, infile_names, _, context):
-        assert infile_names[0].endswith('.handlebars'), infile_names
+        return 4
 
-        assert self.should_compile(infile_names[0]), infile_names[0]
-        self._compile_file_to_python(self.abspath(infile_names[0]),
-                                     self.abspath(outfile_name))
-        log.v3("Compiled handlebars: %s -> %s",
-               infile_names[0], outfile_name)
+    def build_many(self, outfile_infiles_changed_context):
+        compile_args = []
+        for (outfile_name, infile_names, _, _) in (
+                outfile_infiles_changed_context):
+            assert infile_names[0].endswith('.handlebars'), infile_names
+            assert self.should_compile(infile_names[0]), infile_names[0]
+            compile_args.append((self.abspath(infile_names[0]),
+                                 self.abspath(outfile_name)))
+
+        compile_util.map_in_subprocesses(_compile_to_python, compile_args,
+                                         _MIN_FILES_FOR_PARALLEL_COMPILE,
+                                         initializer=_pybars_compiler)
+
+        for (outfile_name, infile_names, _, _) in (
+                outfile_infiles_changed_context):
+            log.v3("Compiled handlebars: %s -> %s",
+                   infile_names[0], outfile_name)
+
+    def split_outputs(self, outfile_infiles_changed_context, num_processes):
+        """Split compiles into one chunk per process."""
+        return compile_util.split_outputs_evenly(
+            outfile_infiles_changed_context, num_processes)
 
     @staticmethod
     def should_compile(handlebars_path):
@@ -56,70 +151,74 @@ class CompilePyHandlebars(compile_rule.CompileBase):
             # Get to the english-language version of the name
             handlebars_path = os.sep.join(handlebars_path.split(os.sep)[3:])
 
-        return os.path.exists(
-            CompilePyHandlebars.abspath(handlebars_path + ".json"))
+        # We go through filemod_db so we share its per-build stat cache.
+        (mtime, _, _) = filemod_db.get_file_info(handlebars_path + ".json")
+        return mtime is not None
 
     def _compile_file_to_python(self, input_filename, output_filename):
         """filenames should be absolute.  Sets up __init__.py's as well."""
-        import third_party.pybars
+        # newline='' keeps io.open from translating \r\n, as open() didn't.
+        with io.open(input_filename, encoding='utf-8', newline='') as f:
+            source = f.read()
+        source = _ELSE_RE.sub("{{^}}", source)
+        template = _pybars_compiler().compile(source)
 
-        with open(input_filename) as in_file:
-            source = in_file.read().decode('utf-8')
-        # Pybars doesn't handle {{else}} for some reason
-        source = re.sub(r'{{\s*else\s*}}', "{{^}}", source)
-        template = third_party.pybars.Compiler().compile(source)
+        output = io.BytesIO()
 
-        output_string = []
+        def emit(line):
+            output.write(line.encode('utf-8'))
+            output.write('\n')
 
         # Some translated content may show up as literal utf-8 strings
         # in the code.  Make sure __import__ can handle that.  See
         #   genfiles/compiled_handlebars_py/pt-BR/'
         #   javascript/discussion-package/question-form.py
         # for an example.
-        output_string.append("# coding: utf-8")
+        emit("# coding: utf-8")
 
-        output_string.append("import third_party.pybars as pybars")
+        emit("import third_party.pybars as pybars")
         # We need to import strlist from pybars instead of
         # third_party.pybars._compiler because pybars
         # add_escaped_expand() checks the type against
         # pybars._compiler.strlist without the third_party.
-        output_string.append("from pybars._compiler import strlist")
-        output_string.append("from third_party.pybars._compiler import "
-                             "_pybars_, Scope, escape, resolve, partial")
-        output_string.append("")
+        emit("from pybars._compiler import strlist")
+        emit("from third_party.pybars._compiler import "
+             "_pybars_, Scope, escape, resolve, partial")
+        emit("")
 
         def write_fn(template, name, indent):
-            output_string.append(
-                "%sdef %s(context, helpers=None, partials=None):"
-                % (indent, name))
-            output_string.append("%s    pybars = _pybars_" % indent)
-            output_string.append("")
-
-            output_string.append("%s    # Begin constants" % indent)
-            for name, val in template.func_globals.items():
-                if name.startswith("constant_"):
-                    if isinstance(val, unicode):
-                        output_string.append("%s    %s = %s" %
-                                             (indent, name, repr(val)))
-            output_string.append("")
-            for name, val in template.func_globals.items():
-                if name.startswith("constant_"):
-                    if isinstance(val, types.FunctionType):
-                        write_fn(val, name, indent + "    ")
-            output_string.append("%s    # End constants" % indent)
-
-            compiled_fn = inspect.getsource(template).decode('utf-8')
-            fn_lines = compiled_fn.split("\n")
+            emit("%sdef %s(context, helpers=None, partials=None):"
+                 % (indent, name))
+            emit("%s    pybars = _pybars_" % indent)
+            emit("")
+
+            (string_constants, function_constants) = (
+                _template_constants(template))
+
+            emit("%s    # Begin constants" % indent)
+            for name, val in string_constants:
+                # repr() of a unicode object is an ascii str already.
+                output.write("%s    %s = %r\n" % (indent, name, val))
+            emit("")
+            for name, val in function_constants:
+                write_fn(val, name, indent + "    ")
+            emit("%s    # End constants" % indent)
+
+            # The compiled source is utf-8 already, so we copy it
+            # through as bytes rather than decoding and re-encoding it.
+            fn_lines = _template_source(template).split("\n")
             for line in fn_lines[1:]:
-                output_string.append("%s%s" % (indent, line))
+                output.write(indent)     # cheaper than formatting it in
+                output.write(line)
+                output.write("\n")
 
         # The function name is the same as our filename, but with _, not -.
         function_name = os.path.splitext(os.path.basename(output_filename))[0]
         function_name = function_name.replace('-', '_')
         write_fn(template, function_name, "")
 
-        with open(output_filename, 'w') as out_file:
-            out_file.write("\n".join(output_string).encode('utf-8'))
+        with open(output_filename, 'wb') as out_file:
+            out_file.write(output.getvalue())
 
 
 class CompileInitFiles(compile_rule.CompileBase):
@@ -130,12 +229,18 @@ class CompileInitFiles(compile_rule.CompileBase):
 
     def build(self, outfile_name, infile_names, _, context):
         dirpath = os.path.dirname(outfile_name)
-        while dirpath:
-            init_file = self.abspath(dirpath, '__init__.py')
-            if not os.path.exists(init_file):
-                open(init_file, 'w').close()
-                log.info('WROTE %s', init_file)
-            dirpath = os.path.dirname(dirpath)
+        dirparts = dirpath.split(os.sep) if dirpath else []
+        for i in xrange(len(dirparts), 0, -1):
+            init_file = self.abspath(*(dirparts[:i] + ['__init__.py']))
+            # O_EXCL lets us check for existence and create in one go.
+            try:
+                os.close(os.open(init_file,
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644))
+            except OSError as why:
+                if why.errno == 17:      # "File exists"
+                    continue
+                raise
+            log.info('WROTE %s', init_file)
 
 
 class CompileHandlebarsPartials(compile_rule.CompileBase):
@@ -145,23 +250,30 @@ class CompileHandlebarsPartials(compile_rule.CompileBase):
         return 2
 
     def build(self, outfile_name, infile_names, _, context):
-        infile_names.sort()    # just to keep the output deterministic
+        lines = ['from handlebars.render import handlebars_template\n',
+                 '\n',
+                 'handlebars_partials = {\n']
+        # We only need to store partials for handlebars files we
+        # compile to python, that is, those with a .json file (see
+        # CompilePyHandlebars.should_compile).  It's cheaper to list
+        # each package dir once than to check every template.
+        json_files = set()
+        for dirname in set(os.path.dirname(f) for f in infile_names):
+            json_files.update(os.path.join(dirname, f)
+                              for f in os.listdir(self.abspath(dirname))
+                              if f.endswith('.handlebars.json'))
+
+        # We sort just to keep the output deterministic.
+        for infile_name in sorted(infile_names):
+            if infile_name + '.json' not in json_files:
+                continue
+            pkg_name = _extract_pkg_base_name_from_path(infile_name)
+            basename = os.path.splitext(os.path.basename(infile_name))[0]
+            lines.append(_PARTIAL_LINE.format(pkg_name, basename))
+        lines.append('}\n')
+
         with open(self.abspath(outfile_name), 'w') as f:
-            print >>f, 'from handlebars.render import handlebars_template'
-            print >>f
-            print >>f, 'handlebars_partials = {'
-            for infile_name in infile_names:
-                # We only need to store partials for handlebars files
-                # we compile to python.
-                if not CompilePyHandlebars.should_compile(infile_name):
-                    continue
-                pkg_name = _extract_pkg_base_name_from_path(infile_name)
-                basename = os.path.splitext(os.path.basename(infile_name))[0]
-                print >>f, ('    "%s_%s": '
-                            'lambda params, partials=None, helpers=None: '
-                            'handlebars_template("%s", "%s", params),'
-                            % (pkg_name, basename, pkg_name, basename))
-            print >>f, '}'
+            f.write(''.join(lines))
 
 
 class CompileJsHandlebars(compile_rule.CompileBase):
@@ -188,8 +300,43 @@ class CompileJsHandlebars(compile_rule.CompileBase):
                                  self.abspath(output)))
 
         if compile_args:
-            self.call_with_input(['node', compiler],
-                                 input=json.dumps(compile_args))
+            self._call_compiler(compiler, compile_args)
+
+    def _call_compiler(self, compiler, compile_args):
+        """Like call_with_input(), but streams the json input to node.
+
+        We write the json for compile_args a pair at a time, rather
+        than building one big string for thousands of templates.
+        """
+        log.v3('Calling %s', ['node', compiler])
+        sub_stderr = subprocess.PIPE
+        if sys.stdout == sys.stderr:
+            sub_stderr = subprocess.STDOUT
+        p = subprocess.Popen(['node', compiler],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=sub_stderr,
+                             cwd=project_root.root,
+                             bufsize=65536)
+        try:
+            p.stdin.write('[')
+            for (i, args) in enumerate(compile_args):
+                if i:
+                    p.stdin.write(',')
+                p.stdin.write(json.dumps(args))
+            p.stdin.write(']')
+        except IOError:
+            # node died on us; we'll see its error (and exit code) below.
+            pass
+        (stdout, stderr) = p.communicate()
+
+        sys.stdout.write(stdout)
+        # stderr will be None if we used subprocess.STDOUT above.
+        if stderr:
+            sys.stderr.write(stderr)
+
+        if p.returncode != 0:
+            raise compile_rule.CompileFailure(
+                "Command FAILED (rc %d): node %s" % (p.returncode, compiler))
 
     def num_outputs(self):
         """stdin can take as much data as we can throw at it!"""
@@ -2,7 +2,6 @@
 
 from __future__ import absolute_import
 
-import contextlib
 import os
 
 import jinja2.nodes
@@ -10,30 +9,23 @@ import jinja2.nodes
 from kake.lib import compile_rule
 
 
-@contextlib.contextmanager
-def _patch(object, attr, newval):
-    """A simple version of mock.patch, so we don't have to import mock."""
-    oldval = getattr(object, attr)
-    setattr(object, attr, newval)
-    try:
-        yield
-    finally:
-        setattr(object, attr, oldval)
-
-
 def _can_never_be_const(*args, **kwargs):
     """Version of nodes.Filter.as_const that disables constant-folding."""
     raise jinja2.nodes.Impossible()
 
 
-class CompileJinja2Templates(compile_rule.CompileBase):
-    """Compiles all jinja2 .html files and puts them in a zipfile."""
-    def version(self):
-        """Update every time build() changes in a way that affects output."""
-        return 2
+# Our infiles are relative to ka-root, but jinja2 wants them relative
+# to the templates/ directory.
+_TEMPLATES_PREFIX = 'templates' + os.sep
 
-    def build(self, outfile_name, infile_names, _, context):
-        import jinja2
+# Setting up the environment is expensive, so we do it once per process.
+_JINJA_ENV = None
+
+
+def _jinja_env():
+    """Return our app's jinja2 environment, creating it on first use."""
+    global _JINJA_ENV
+    if _JINJA_ENV is None:
         import webapp2
         import webapp2_extras.jinja2
 
@@ -43,29 +35,45 @@ class CompileJinja2Templates(compile_rule.CompileBase):
         # actually needed.  This keeps most of kake lightweight.
         import config_jinja          # @UnusedImport
 
-        # The jinja2 routines work relative to the templates/ directory.
-        rootdir = self.abspath('templates')
-        rel_infiles = [f[len('templates' + os.sep):] for f in infile_names]
+        # Turn off constant-folding of filters -- the jinja2
+        # optimizer is unsound in that it does 'constant'-folding of
+        # function calls that are not constant (because they depend on
+        # os.environ, say).  This was breaking use of the static_url
+        # filter, among others.  It's just as unsound for anyone else
+        # in this process, so we don't bother to ever undo this.
+        jinja2.nodes.Filter.as_const = _can_never_be_const
 
         app = webapp2.WSGIApplication()
-        env = webapp2_extras.jinja2.get_jinja2(app=app).environment
+        _JINJA_ENV = webapp2_extras.jinja2.get_jinja2(app=app).environment
+    return _JINJA_ENV
 
-        # 1) Mock our environment to use the filesystem loader, but
+
+class CompileJinja2Templates(compile_rule.CompileBase):
+    """Compiles all jinja2 .html files and puts them in a zipfile."""
+    def version(self):
+        """Update every time build() changes in a way that affects output."""
+        return 2
+
+    def build(self, outfile_name, infile_names, _, context):
+        env = _jinja_env()
+
+        # The jinja2 routines work relative to the templates/ directory.
+        rootdir = self.abspath('templates')
+        rel_infiles = tuple(f[len(_TEMPLATES_PREFIX):] for f in infile_names)
+
+        # Mock our environment to use the filesystem loader, but
         # to get the list of filenames directly from us.
-        # 2) Turn off constant-folding of filters -- the jinja2
-        # optimizer is unsound in that it does 'constant'-folding of
-        # function calls that are not constant (because they depend on
-        # os.environ, say).  This was breaking use of the static_url
-        # filter, among others.
-        with _patch(jinja2.nodes.Filter, 'as_const', _can_never_be_const):
-            with _patch(env, 'loader', jinja2.FileSystemLoader(rootdir)):
-                with _patch(env, 'list_templates', lambda *args: rel_infiles):
-                    # Compile templates to zip, crashing on any
-                    # compilation errors.
-                    env.compile_templates(outfile_name,
-                                          ignore_errors=False,
-                                          py_compile=True,
-                                          zip='deflated')
+        (old_loader, old_list_templates) = (env.loader, env.list_templates)
+        env.loader = jinja2.FileSystemLoader(rootdir)
+        env.list_templates = lambda *args: rel_infiles
+        try:
+            # Compile templates to zip, crashing on any compilation errors.
+            env.compile_templates(outfile_name,
+                                  ignore_errors=False,
+                                  py_compile=True,
+                                  zip='deflated')
+        finally:
+            (env.loader, env.list_templates) = (old_loader, old_list_templates)
 
 
 compile_rule.register_compile(
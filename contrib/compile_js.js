@@ -4,14 +4,27 @@
  *
  * Usage:
  *  node compile_js.js [options] < input_output_paths.json
+ *  node compile_js.js --server
  *
  * The input_output_paths.json should contain an array of tuples with absolute
  * input and output paths, e.g.
  * [[input_path_1, output_path_1], [input_path_2, output_path_2], ...]
+ *
+ * With --server, we instead read requests from stdin, one json object per
+ * line, of the form
+ *    {"id": N, "files": [[input_path_1, output_path_1], ...]}
+ * and write a response line for each when it's done, of the form
+ *    {"id": N, "ok": true} or {"id": N, "err": "<error message>"}
+ * This lets callers avoid paying node and babel startup time per batch.
+ *
+ * Either way, we compile the files in parallel using one child process
+ * per cpu, since babel is cpu-bound.
  */
 "use strict";
 
+const childProcess = require('child_process');
 const fs = require('fs');
+const os = require('os');
 const babel = require('babel-core');
 
 function compile(inPath, outPath) {
@@ -41,24 +54,156 @@ function compile(inPath, outPath) {
         }).code;
         fs.writeFileSync(outPath, outCode, 'utf8');
     } catch (err) {
-        console.log('** Exception while compiling: ' + inPath); //@Nolint
-        console.log(err); //@Nolint
+        // We use stderr so as not to confuse --server clients.
+        console.error('** Exception while compiling: ' + inPath); //@Nolint
+        console.error(err); //@Nolint
         throw err;
     }
 }
 
-// Read a json file saying what to do, from stdin.  The json
-// should look like
-//    [[input_filename, output_filename], ...]
-let dataText = '';
-process.stdin.on('data', function(chunk) {
-    dataText = dataText + chunk;
-});
-process.stdin.on('end', function() {
-    const data = JSON.parse(dataText);
-    data.forEach(function(paths) {
-        const inPath = paths[0];
-        const outPath = paths[1];
-        compile(inPath, outPath);
+// Child processes for compileAll(), started as needed.  Each one
+// compiles a file at a time; see runChild().
+const children = [];
+
+function startChild() {
+    const child = childProcess.fork(__filename, ['--child'], {
+        // Our stdout is reserved for --server responses.
+        stdio: ['ignore', 'ignore', 'inherit', 'ipc'],
+    });
+    child.on('exit', function(code) {
+        if (code !== 0) {
+            console.error('compile_js.js child exited unexpectedly'); //@Nolint
+            process.exit(1);
+        }
+    });
+    return child;
+}
+
+// Compile all files, calling callback with an error message (or
+// null) when done.  We stop handing out files after the first error.
+function compileAll(files, callback) {
+    const numChildren = Math.min(files.length, os.cpus().length);
+    if (numChildren <= 1) {
+        // Not worth the overhead of talking to a child.
+        try {
+            files.forEach(function(paths) {
+                compile(paths[0], paths[1]);
+            });
+        } catch (err) {
+            callback(String(err.stack || err));
+            return;
+        }
+        callback(null);
+        return;
+    }
+
+    while (children.length < numChildren) {
+        children.push(startChild());
+    }
+    let next = 0;
+    let running = numChildren;
+    let error = null;
+    function runNext(child) {
+        if (next >= files.length || error !== null) {
+            running--;
+            if (running === 0) {
+                callback(error);
+            }
+            return;
+        }
+        const paths = files[next++];
+        child.once('message', function(result) {
+            if (result.err && error === null) {
+                error = result.err;
+            }
+            runNext(child);
+        });
+        child.send(paths);
+    }
+    for (let i = 0; i < numChildren; i++) {
+        runNext(children[i]);
+    }
+}
+
+function runChild() {
+    process.on('message', function(paths) {
+        const result = {};
+        try {
+            compile(paths[0], paths[1]);
+        } catch (err) {
+            result.err = String(err.stack || err);
+        }
+        process.send(result);
+    });
+}
+
+function serve() {
+    const readline = require('readline');
+    const lines = readline.createInterface({input: process.stdin});
+    // compileAll() shares the children, so we handle one request at
+    // a time, in order.
+    const requests = [];
+    let busy = false;
+    let closed = false;
+    function handleNext() {
+        if (requests.length === 0) {
+            busy = false;
+            if (closed) {
+                children.forEach(function(child) {
+                    child.disconnect();
+                });
+            }
+            return;
+        }
+        busy = true;
+        const request = requests.shift();
+        compileAll(request.files, function(err) {
+            const response = {id: request.id};
+            if (err === null) {
+                response.ok = true;
+            } else {
+                response.err = err;
+            }
+            process.stdout.write(JSON.stringify(response) + '\n');
+            handleNext();
+        });
+    }
+    lines.on('line', function(line) {
+        requests.push(JSON.parse(line));
+        if (!busy) {
+            handleNext();
+        }
+    });
+    lines.on('close', function() {
+        closed = true;
+        if (!busy) {
+            handleNext();
+        }
+    });
+}
+
+if (process.argv.indexOf('--child') !== -1) {
+    runChild();
+} else if (process.argv.indexOf('--server') !== -1) {
+    serve();
+} else {
+    // Read a json file saying what to do, from stdin.  The json
+    // should look like
+    //    [[input_filename, output_filename], ...]
+    let dataText = '';
+    process.stdin.on('data', function(chunk) {
+        dataText = dataText + chunk;
+    });
+    process.stdin.on('end', function() {
+        const data = JSON.parse(dataText);
+        compileAll(data, function(err) {
+            children.forEach(function(child) {
+                child.disconnect();
+            });
+            if (err !== null) {
+                // compile() has already logged the error.
+                process.exitCode = 1;
+            }
+        });
     });
-});
+}
@@ -29,8 +29,19 @@ files as part of the symlinking process.
 
 from __future__ import absolute_import
 
+import atexit
+import cPickle
+import multiprocessing.pool
 import os
 import re
+import tempfile
+
+try:
+    # re2 matches in linear time, without backtracking, which makes
+    # scanning the thousands of files in a dep-graph a lot cheaper.
+    import re2
+except ImportError:
+    re2 = None
 
 from shared import ka_root
 
@@ -41,6 +52,8 @@ import js_css_packages.util
 from kake import compile_js_css_packages
 from kake.lib import compile_rule
 from kake.lib import computed_inputs
+from kake.lib import filemod_db
+from kake.lib import project_root
 
 # List of files that are treated specially because they're entry points in test
 # systems. They're special because they use information from the context to
@@ -49,6 +62,120 @@ _TEST_ENTRY_POINTS = frozenset([
     'javascript/testindex.js',
 ])
 
+# Every file in every bundle is checked against these, so we look
+# them up once rather than on each use.
+_IMPLICIT_JS_FILE_DEPS = compile_js_css_packages.IMPLICIT_JS_FILE_DEPS
+_IMPLICIT_JS_FILE_DEPS_SET = compile_js_css_packages.IMPLICIT_JS_FILE_DEPS_SET
+
+# A map from require-regexp string to the compiled regexp, so every
+# ComputedJavaScriptInputs compiles each of its (two) regexps just once.
+_REQUIRE_RES = {}
+
+# Used to check that a path isn't in genfiles without splitting it up.
+_GENFILES_PREFIX = 'genfiles' + os.sep
+_GENFILES_DIR = os.sep + _GENFILES_PREFIX
+
+
+def _compile_re(pattern, flags=0):
+    """re.compile(), but using re2 if it's installed and can handle pattern."""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern, flags)
+        except Exception:      # re2 doesn't support backreferences, etc.
+            pass
+    return re.compile(pattern, flags)
+
+
+# On a cold disk cache, reading files is much of the cost of walking
+# the dependency graph.  So when we learn what files a file includes,
+# we start reading them in background threads while we go on to
+# analyze the files we've already read.
+_PREFETCH_THREADS = 16
+_PREFETCH_POOL = None
+_PREFETCH_POOL_PID = None
+
+
+def _prefetch_pool():
+    global _PREFETCH_POOL, _PREFETCH_POOL_PID
+    # Threads don't survive a fork, so each of kake's build
+    # sub-processes needs a pool of its own.
+    if _PREFETCH_POOL is None or _PREFETCH_POOL_PID != os.getpid():
+        _PREFETCH_POOL = multiprocessing.pool.ThreadPool(_PREFETCH_THREADS)
+        _PREFETCH_POOL_PID = os.getpid()
+    return _PREFETCH_POOL
+
+
+def _close_prefetch_pool():
+    """Stop the prefetch threads, if this process has started any.
+
+    We only need them while walking a dependency graph.  Shutting them
+    down afterwards means no threads are running when kake forks its
+    build sub-processes, as it does at the start of every build (and
+    kake-server and tests run many builds per process).
+    """
+    global _PREFETCH_POOL
+    if _PREFETCH_POOL is not None and _PREFETCH_POOL_PID == os.getpid():
+        _PREFETCH_POOL.terminate()
+        _PREFETCH_POOL.join()
+    _PREFETCH_POOL = None
+
+
+def _read_file(infile):
+    """Return the contents of infile, which is relative to ka-root.
+
+    We read with a single os.read() of the file's size, which skips
+    setting up a buffered file object for each of the thousands of
+    files in a dependency graph.
+    """
+    fd = os.open(ka_root.join(infile), os.O_RDONLY)
+    try:
+        contents = os.read(fd, os.fstat(fd).st_size)
+        while True:     # in case the file grew, or the read came up short
+            more = os.read(fd, 65536)
+            if not more:
+                return contents
+            contents += more
+    finally:
+        os.close(fd)
+
+
+# Where we save the include-cache between kake runs, so a new kake
+# process doesn't have to re-read and re-analyze every file in the
+# dependency graph when only a few of them have changed.  The entries
+# are validated against the files' mtimes, just like in memory.
+_INCLUDE_CACHE_FILE = os.path.join('genfiles', '_js_include_cache',
+                                   'includes%s.pickle')
+
+
+def _read_include_cache(abs_filename):
+    try:
+        with open(abs_filename, 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return {}
+
+
+# Every ComputedJavaScriptInputs we've made, so we can save all their
+# include-caches when we exit.
+_ALL_COMPUTED_JS_INPUTS = []
+
+
+@atexit.register
+def _atexit_save_include_caches():
+    # This function isn't meant to be called manually.  We save once,
+    # at exit, rather than after every build, since each save rewrites
+    # the whole include-cache file.
+    for computed_js_inputs in _ALL_COMPUTED_JS_INPUTS:
+        computed_js_inputs._save_include_cache()
+
+
+# get_required_dependencies() is called for every file in the
+# dependency graph, so rather than making a new ComputedJavaScriptInputs
+# (with an empty include-cache) each time, we share one per
+# top_level_only value.  We key on the project root too, since tests
+# change it out from under us.
+_COMPUTED_JS_INPUTS = {}
+
 
 def get_required_dependencies(filename, dev, pkg_locale, top_level_only=False):
     """Return the list of files that the given file require().
@@ -58,8 +185,11 @@ def get_required_dependencies(filename, dev, pkg_locale, top_level_only=False):
     If top_level_only is True, we will only look at 'require' lines at
     the top level, that is not inside a function/etc.
     """
-    computed_js_inputs = ComputedJavaScriptInputs('{{path}}.js',
-                                                  top_level_only)
+    key = (project_root.root, top_level_only)
+    if key not in _COMPUTED_JS_INPUTS:
+        _COMPUTED_JS_INPUTS[key] = ComputedJavaScriptInputs('{{path}}.js',
+                                                            top_level_only)
+    computed_js_inputs = _COMPUTED_JS_INPUTS[key]
     context = {
         '{lang}': pkg_locale,
         '{env}': 'dev' if dev else 'prod',
@@ -68,20 +198,17 @@ def get_required_dependencies(filename, dev, pkg_locale, top_level_only=False):
 
     explicit_deps = computed_js_inputs.included_files(filename, context)
 
-    IMPLICIT_FILE_DEPS = compile_js_css_packages.IMPLICIT_JS_FILE_DEPS
-    IMPLICIT_FILE_DEPS_SET = compile_js_css_packages.IMPLICIT_JS_FILE_DEPS_SET
-
     # Every file also implicitly depends on the module system and polyfills,
     # except those that are themselves part of the module system or polyfills.
-    if filename in IMPLICIT_FILE_DEPS_SET:
+    if filename in _IMPLICIT_JS_FILE_DEPS_SET:
         return explicit_deps
     else:
         for f in explicit_deps:
-            assert f not in IMPLICIT_FILE_DEPS_SET, (
+            assert f not in _IMPLICIT_JS_FILE_DEPS_SET, (
                 "Files may not explicitly depend upon %s. "
                 "Check dependencies of %s" % (f, filename))
 
-        return IMPLICIT_FILE_DEPS + explicit_deps
+        return _IMPLICIT_JS_FILE_DEPS + explicit_deps
 
 
 class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
@@ -112,10 +239,15 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
         if top_level_only:
             require_re = r'^(?:\S.*)?' + require_re
 
+        if require_re not in _REQUIRE_RES:
+            _REQUIRE_RES[require_re] = _compile_re(require_re, re.MULTILINE)
+
         super(ComputedJavaScriptInputs, self).__init__(
             base_file_pattern,
-            require_re,
-            other_inputs=compile_js_css_packages.IMPLICIT_JS_FILE_DEPS)
+            _REQUIRE_RES[require_re],
+            other_inputs=_IMPLICIT_JS_FILE_DEPS)
+
+        _ALL_COMPUTED_JS_INPUTS.append(self)
 
     def version(self):
         """Update whenever input_patterns() or trigger_files() changes."""
@@ -126,26 +258,154 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
         """Tell the build system our output depends on these context vars."""
         return ['testfiles']
 
-    def input_patterns(self, outfile_name, context, triggers, changed):
-        files = super(ComputedJavaScriptInputs, self).input_patterns(
-                        outfile_name, context, triggers, changed)
-
-        def file_order(f):
-            # We want to load the test entry point last to allow all the
-            # tests to register themselves before starting tests
-            if f in _TEST_ENTRY_POINTS:
-                return 1
+    def clear_caches(self):
+        super(ComputedJavaScriptInputs, self).clear_caches()
+
+        # A map from filename to its file-info and the AsyncResult of
+        # reading it, for files we expect to analyze soon.  See
+        # _prefetch().
+        self._prefetched_contents = {}
+
+        # A map from (source filename, lang) to its compiled filename.
+        # Bundles share most of their files, so this saves redoing the
+        # same path-munging for every bundle.
+        self._compiled_path_cache = {}
+
+        # The (path, realpath, dirname of the realpath) of the file
+        # whose includes we're resolving; see resolve_includee_path().
+        # Symlinks can change between builds, so we only keep this
+        # for one include-cache miss.
+        self._includer_realpath = None
+
+        # Memoized answers from third_party_js, which don't change
+        # while we run: a map from filename to whether we can analyze
+        # it, and from (filename, lang, dev) to (plugins, deps).
+        self._can_analyze_cache = {}
+        self._listed_files_cache = {}
+
+        # The project-root we've loaded the saved include-cache for,
+        # and whether we've added to the include-cache since.
+        self._include_cache_root = None
+        self._include_cache_dirty = False
+
+    def _include_cache_filename(self):
+        return _INCLUDE_CACHE_FILE % ('.top_level' if self.top_level_only
+                                      else '')
+
+    def _load_include_cache(self, context):
+        """Seed the include-cache with what an earlier kake run saved."""
+        version = self.full_version(context)
+        if self._include_cache_version != version:
+            self.clear_caches()
+            self._include_cache_version = version
+        self._include_cache_root = project_root.root
+
+        saved = _read_include_cache(
+            project_root.join(self._include_cache_filename()))
+        if saved.get('version') == version:
+            for (key, value) in saved['include_cache'].iteritems():
+                self._include_cache.setdefault(key, value)
+
+    def _save_include_cache(self):
+        """Save the include-cache to disk for the next kake run."""
+        if not self._include_cache_dirty or self._include_cache_root is None:
+            return
+        if not os.path.isdir(self._include_cache_root):
+            return      # probably a test tmpdir that's been deleted
+        include_cache = self._include_cache
+        filename = os.path.join(self._include_cache_root,
+                                self._include_cache_filename())
+        # Other kake processes may have saved entries we don't have.
+        saved = _read_include_cache(filename)
+        if saved.get('version') == self._include_cache_version:
+            saved['include_cache'].update(include_cache)
+            include_cache = saved['include_cache']
+
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except (IOError, OSError):
+            pass    # a concurrent process could have made this dir
+        (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump({'version': self._include_cache_version,
+                              'include_cache': include_cache},
+                             f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpname, filename)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+        self._include_cache_dirty = False
+
+    def _can_analyze(self, infile):
+        can_analyze = self._can_analyze_cache.get(infile)
+        if can_analyze is None:
+            can_analyze = third_party_js.can_analyze_for_dependencies(infile)
+            self._can_analyze_cache[infile] = can_analyze
+        return can_analyze
+
+    def _listed_files(self, infile, pkg_locale, dev):
+        """Return third_party_js's (plugins, dependencies) for infile.
+
+        We only need the dependencies for files we can't analyze;
+        for the others, they are None.
+        """
+        key = (infile, pkg_locale, dev)
+        listed_files = self._listed_files_cache.get(key)
+        if listed_files is None:
+            if self._can_analyze(infile):
+                deps = None
+            else:
+                deps = third_party_js.listed_dependencies(infile, pkg_locale,
+                                                          dev)
+            listed_files = (
+                third_party_js.listed_plugins(infile, pkg_locale, dev), deps)
+            self._listed_files_cache[key] = listed_files
+        return listed_files
+
+    def _prefetch(self, infiles, context):
+        """Start reading the files we'll need to analyze, in the background.
+
+        We skip files whose includes are (probably) already cached, and
+        files we never analyze.
+        """
+        context_key = self._include_cache_context_key(context)
+        for infile in infiles:
+            if (infile not in self._prefetched_contents and
+                    infile.endswith(('.js', '.jsx')) and
+                    self._can_analyze(infile) and
+                    (infile,) + context_key not in self._include_cache):
+                file_info = filemod_db.get_file_info(
+                    infile, compute_crc=self.compute_crc)
+                self._prefetched_contents[infile] = (
+                    file_info,
+                    _prefetch_pool().apply_async(_read_file, (infile,)))
+
+    def _include_cache_context_key(self, context):
+        """Only these context vars affect what files a js file includes.
+
+        In particular, the {{path}} of the bundle being built does
+        not, so bundles that share files can share cache entries.
+        """
+        return (context['{lang}'], context['{env}'], context.get('testfiles'))
+
+    def _include_cache_key(self, infile, context):
+        return (infile,) + self._include_cache_context_key(context)
 
-            return 0
+    def input_patterns(self, outfile_name, context, triggers, changed):
+        try:
+            files = super(ComputedJavaScriptInputs, self).input_patterns(
+                            outfile_name, context, triggers, changed)
+        finally:
+            # Anything we prefetched but didn't analyze is just taking
+            # up memory now, and could go stale before the next walk.
+            self._prefetched_contents.clear()
+            _close_prefetch_pool()
 
         assert 'js_css_packages/third_party_js.py' == files[0]
         third_party_js = files[0]
         input_files = files[1:]
 
-        IMPLICIT_FILE_DEPS = compile_js_css_packages.IMPLICIT_JS_FILE_DEPS
-        IMPLICIT_FILE_DEPS_SET = \
-            compile_js_css_packages.IMPLICIT_JS_FILE_DEPS_SET
-
         # The ordering of files should be:
         #   1. All of the IMPLICIT_JS_FILE_DEPS
         #   2. All of our actual source trigger files (that are also inputs)
@@ -160,42 +420,77 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
         # same file more than once we determine any shared entries in
         # files and IMPLICIT_JS_FILE_DEPS and remove the duplicates
         # from files.
-        duplicates = IMPLICIT_FILE_DEPS_SET.intersection(set(input_files))
-        for dup in duplicates:
-            input_files.remove(dup)
-
-        input_files.sort(key=file_order)
+        input_files = [f for f in input_files
+                       if f not in _IMPLICIT_JS_FILE_DEPS_SET]
+
+        # We want to load the test entry point last to allow all the
+        # tests to register themselves before starting tests.  Only
+        # test bundles have one, and isdisjoint() checks for that
+        # without a python-level loop over all the files.
+        if not _TEST_ENTRY_POINTS.isdisjoint(input_files):
+            input_files = ([f for f in input_files
+                            if f not in _TEST_ENTRY_POINTS] +
+                           [f for f in input_files
+                            if f in _TEST_ENTRY_POINTS])
 
         # The trigger files are specified as source files, but we want
-        # to put the compiled file into our bundle.
+        # to put the compiled file into our bundle.  We add them right
+        # into the return value, after the IMPLICIT_JS_FILE_DEPS.
         pkg_locale = context['{lang}']
-        compiled_input_files = [
-            js_css_packages.util.source_path_to_compiled_path(f, pkg_locale)
-            for f in input_files]
-
-        retfiles = (IMPLICIT_FILE_DEPS +
-                    compiled_input_files +
-                    # TODO(csilvers): use just path-to-packages for files[0]
-                    [('genfiles/paths_and_packages/%s/js/'
-                      'all_paths_to_packages_%s.json' %
-                      (context['{lang}'], context['{env}'])),
-                     'javascript-packages.json',
-                     third_party_js])
+        retfiles = list(_IMPLICIT_JS_FILE_DEPS)
+        for f in input_files:
+            compiled_path = self._compiled_path_cache.get((f, pkg_locale))
+            if compiled_path is None:
+                compiled_path = (
+                    js_css_packages.util.source_path_to_compiled_path(
+                        f, pkg_locale))
+                self._compiled_path_cache[(f, pkg_locale)] = compiled_path
+            retfiles.append(compiled_path)
+
+        retfiles.extend([
+            # TODO(csilvers): use just path-to-packages for files[0]
+            ('genfiles/paths_and_packages/%s/js/'
+             'all_paths_to_packages_%s.json' % (pkg_locale, context['{env}'])),
+            'javascript-packages.json',
+            third_party_js])
 
         return retfiles
 
     def _get_contents_for_analysis(self, infile):
-        with open(ka_root.join(infile)) as f:
-            contents = f.read()
-
-        # Strip out comments before we search for calls to require()
+        # We only analyze files whose includes aren't in the cache.
+        self._include_cache_dirty = True
+        self._includer_realpath = None
+
+        # The file may have changed since we prefetched it.
+        (file_info, prefetched) = self._prefetched_contents.pop(
+            infile, (None, None))
+        if prefetched is not None and filemod_db.file_info_equal(
+                file_info, filemod_db.get_file_info(
+                    infile, compute_crc=self.compute_crc)):
+            contents = prefetched.get()
+        else:
+            contents = _read_file(infile)
+
+        # Leaf files, which are many, require() nothing.  A substring
+        # search finds that out much faster than the regexp can, and
+        # saves us stripping comments from them as well.
+        if 'require' not in contents:
+            return ''
+
+        # Strip out comments before we search for calls to require().
+        # A file without any comment-starts has nothing to strip, and
+        # we can skip the (fairly expensive) stripping pass entirely.
+        if '//' not in contents and '/*' not in contents:
+            return contents
         return js_css_packages.analysis.strip_js_comments(contents)
 
-    # e.g. {{#invokePartial "shared" "progress-icon-subway"
-    _INVOKE_PARTIAL_RE = re.compile(r'#invokePartial\s+"([^"]*)"\s+"([^"]*)')
-
-    # e.g. {{> shared_throbber-grid}}
-    _PARTIAL_RE = re.compile(r'{{>[\s]*([\w-]+)_([\w-]+)?[\s]*}}')
+    # Matches either of
+    #    {{#invokePartial "shared" "progress-icon-subway"
+    #    {{> shared_throbber-grid}}
+    # so we can find both kinds of partial in one pass over the file.
+    _PARTIALS_RE = _compile_re(
+        r'#invokePartial\s+"(?P<invoke_pkg>[^"]*)"\s+"(?P<invoke_tpl>[^"]*)'
+        r'|{{>[\s]*(?P<pkg>[\w-]+)_(?P<tpl>[\w-]+)?[\s]*}}')
 
     def included_handlebars_files(self, handlebars_infile, context):
         """Return a list of filepaths the given template templates on."""
@@ -210,21 +505,28 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
         if self.top_level_only:
             return deps
 
-        with open(ka_root.join(handlebars_infile)) as f:
-            contents = f.read()
+        contents = _read_file(handlebars_infile)
 
-        for pattern in [self._INVOKE_PARTIAL_RE, self._PARTIAL_RE]:
-            for m in pattern.finditer(contents):
-                package_name = m.group(1)
-                template_name = m.group(2)
+        # Most templates include no other templates; for them we can
+        # skip the regexps entirely.
+        if '{{>' not in contents and '#invokePartial' not in contents:
+            return deps
 
+        # We list all the invokePartial deps before all the {{>}} deps.
+        partial_deps = []
+        for m in self._PARTIALS_RE.finditer(contents):
+            if m.group('invoke_pkg') is not None:
                 deps.append('javascript/%s-package/%s.handlebars' %
-                            (package_name, template_name))
+                            (m.group('invoke_pkg'), m.group('invoke_tpl')))
+            else:
+                partial_deps.append('javascript/%s-package/%s.handlebars' %
+                                    (m.group('pkg'), m.group('tpl')))
 
-        return deps
+        return deps + partial_deps
 
     def included_files(self, infile, context):
-        infile_parts = infile.split(os.sep)
+        if self._include_cache_root != project_root.root:
+            self._load_include_cache(context)
 
         pkg_locale = context['{lang}']
         dev = (context['{env}'] != 'prod')
@@ -232,17 +534,16 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
         # Plugins for file x are files we want loaded after x whenever x is
         # used. e.g. jquery.timeago.{{lang}}.js is a plugin dependency of
         # jquery.timeago.js.
-        plugins = third_party_js.listed_plugins(infile, pkg_locale, dev)
+        (plugins, listed_deps) = self._listed_files(infile, pkg_locale, dev)
 
-        if not third_party_js.can_analyze_for_dependencies(infile):
-            return (plugins +
-                    third_party_js.listed_dependencies(infile, pkg_locale,
-                                                       dev))
+        if listed_deps is not None:     # we can't analyze infile
+            return plugins + listed_deps
 
         # Ensure that if we need to do analysis, we're always
         # resolving dependencies in the source tree, and not in
         # genfiles.
-        assert 'genfiles' not in infile_parts, infile
+        assert not (infile.startswith(_GENFILES_PREFIX) or
+                    _GENFILES_DIR in infile), infile
 
         if infile in _TEST_ENTRY_POINTS:
             # To support the test system allowing us to specify a subset of
@@ -257,28 +558,40 @@ class ComputedJavaScriptInputs(computed_inputs.ComputedIncludeInputs):
 
             testfiles = context['testfiles'].split(',')
 
-            return super(ComputedJavaScriptInputs, self).included_files(
+            includes = super(ComputedJavaScriptInputs, self).included_files(
                 infile, context) + testfiles
+            self._prefetch(includes, context)
+            return includes
 
         if infile.endswith('.handlebars'):
             return self.included_handlebars_files(infile, context)
 
-        return plugins + super(ComputedJavaScriptInputs, self).included_files(
-            infile, context)
+        includes = plugins + super(ComputedJavaScriptInputs,
+                                   self).included_files(infile, context)
+        self._prefetch(includes, context)
+        return includes
 
     def resolve_includee_path(self, abs_includer_path,
                               includee_path, context):
+        # A file has many includes, so we only look up its realpath
+        # once while resolving them.
+        if (self._includer_realpath is None or
+                self._includer_realpath[0] != abs_includer_path):
+            real_includer_path = os.path.realpath(abs_includer_path)
+            self._includer_realpath = (abs_includer_path, real_includer_path,
+                                       os.path.dirname(real_includer_path))
+        (_, real_includer_path, real_includer_dir) = self._includer_realpath
+
         # If the includee_path has '{{lang}}'/etc in it, we need to
         # resolve it to the actual filename being included.
         if '{{' in includee_path:
             pkg_locale = context['{lang}']
             dev = (context['{env}'] != 'prod')
             includee_path = js_css_packages.util.resolve_filename_vars(
-                includee_path, pkg_locale, dev,
-                os.path.dirname(os.path.realpath(abs_includer_path)))
+                includee_path, pkg_locale, dev, real_includer_dir)
 
         return js_css_packages.require_util.require_to_path(
-            includee_path, os.path.realpath(abs_includer_path))
+            includee_path, real_includer_path)
 
     def trigger_files(self, outfile_name, context):
         triggers = list(super(ComputedJavaScriptInputs, self)
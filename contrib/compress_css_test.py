@@ -7,9 +7,11 @@ from __future__ import absolute_import
 import base64
 import json
 import os
+import shutil
 
 import mock
 
+from kake import compile_autoprefixed_css
 from kake import compress_css
 from kake import make
 import kake.lib.testutil
@@ -35,6 +37,15 @@ class TestCompressCss(kake.lib.testutil.KakeTestBase):
         os.makedirs(self._abspath('css', 'onefile_package'))
         os.makedirs(self._abspath('images'))
 
+        # We need this file from the main repo for autoprefixing.
+        # NOTE: We intentionally make a copy instead of symlinking here
+        # because node resolves dependencies based on where the real
+        # file is, and we want the fake autoprefixer in the sandbox.
+        os.makedirs(self._abspath('kake'))
+        shutil.copyfile(os.path.join(self.real_project_root,
+                                     'kake', 'run_autoprefixer.js'),
+                        self._abspath('kake', 'run_autoprefixer.js'))
+
         with open(self._abspath('css', 'shared_package', 'a.css'), 'w') as f:
             print >>f, 'background-image: url("/images/tiny.png")'
             print >>f, 'background-image:url(/images/other.png)'
@@ -113,6 +124,17 @@ class TestCompressCss(kake.lib.testutil.KakeTestBase):
             'genfiles/compressed_stylesheets/en/css/shared_package/a.min.css')
         self.test_image_info_url()
 
+    def test_autoprefixer_gets_browsers(self):
+        make.build('genfiles/compiled_autoprefixed_css/en/css/'
+                   'shared_package/a.css')
+        # The fake postcss writes the plugins' options to the sourcemap.
+        with open(self._abspath('genfiles', 'compiled_autoprefixed_css', 'en',
+                                'css', 'shared_package', 'a.css.map')) as f:
+            sourcemap = json.load(f)
+        self.assertEqual(
+            [{'browsers': compile_autoprefixed_css._BROWSERS.split(', ')}],
+            sourcemap['plugins'])
+
     def test_rebuild_image_info_url_after_delete(self):
         make.build('genfiles/css_image_url_info.pickle')
 
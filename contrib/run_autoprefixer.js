@@ -0,0 +1,52 @@
+/**
+ * This file is used by the compile_autoprefixed_css.py build rules.  It adds
+ * vendor prefixes to a batch of CSS files, so we only pay for node and
+ * autoprefixer startup once per batch.
+ *
+ * Usage:
+ *  node run_autoprefixer.js < input.json
+ *
+ * The input.json should look like
+ *    {"browsers": "IE >= 10, IOS >= 8",
+ *     "files": [[input_path_1, output_path_1], ...]}
+ * For each file, we write the prefixed css to output_path and its
+ * sourcemap to output_path + '.map', like `autoprefixer --map` does.
+ */
+"use strict";
+
+const fs = require('fs');
+const autoprefixer = require('autoprefixer');
+const postcss = require('postcss');
+
+let dataText = '';
+process.stdin.on('data', function(chunk) {
+    dataText = dataText + chunk;
+});
+process.stdin.on('end', function() {
+    const data = JSON.parse(dataText);
+    const processor = postcss([
+        autoprefixer({browsers: data.browsers.split(/,\s*/)}),
+    ]);
+    data.files.forEach(function(paths) {
+        const inPath = paths[0];
+        const outPath = paths[1];
+        try {
+            const css = fs.readFileSync(inPath, 'utf8');
+            const result = processor.process(css, {
+                from: inPath,
+                to: outPath,
+                map: {inline: false},
+            });
+            fs.writeFileSync(outPath, result.css, 'utf8');
+            if (result.map) {
+                fs.writeFileSync(outPath + '.map', result.map.toString(),
+                                 'utf8');
+            }
+        } catch (err) {
+            console.error('** Exception while autoprefixing: ' + //@Nolint
+                          inPath);
+            console.error(err); //@Nolint
+            throw err;
+        }
+    });
+});
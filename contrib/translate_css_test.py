@@ -4,6 +4,7 @@ from __future__ import absolute_import
 
 import json
 import os
+import shutil
 
 from kake import make
 import kake.lib.testutil
@@ -22,6 +23,15 @@ class TestTranslateAndMirrorCss(kake.lib.testutil.KakeTestBase):
 
         os.makedirs(self._abspath('css', 'shared_package'))
 
+        # We need this file from the main repo for autoprefixing.
+        # NOTE: We intentionally make a copy instead of symlinking here
+        # because node resolves dependencies based on where the real
+        # file is, and we want the fake autoprefixer in the sandbox.
+        os.makedirs(self._abspath('kake'))
+        shutil.copyfile(os.path.join(self.real_project_root,
+                                     'kake', 'run_autoprefixer.js'),
+                        self._abspath('kake', 'run_autoprefixer.js'))
+
         with open(self._abspath('css', 'shared_package', 'a.css'), 'w') as f:
             print >>f, '.foo {'
             print >>f, '    margin-left: 10px'
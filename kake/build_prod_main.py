@@ -357,8 +357,9 @@ def custom_search_engine(build_options):
 
 
 def all_pot_files(build_options):
-    # This will create both the pickled all.pot file, which kake uses
-    # itself, and a human readable all.pot.txt_for_debugging file.
+    # This creates the pickled all.pot file, which kake uses itself.
+    # The human readable all.pot.txt_for_debugging file is only
+    # built when asked for explicitly.
     outfile = os.path.join('genfiles', 'translations',
                            'all.pot.pickle')
     yield (outfile, {})
@@ -65,9 +65,16 @@ from __future__ import absolute_import
 
 import os
 import re
-import subprocess
 import sys
 
+try:
+    # subprocess32 forks and execs in C, which is faster than python2's
+    # subprocess when the parent process is big (as kake can get), and
+    # doesn't run any python in the child between fork and exec.
+    import subprocess32 as subprocess
+except ImportError:
+    import subprocess
+
 from . import compile_util
 from . import log
 from . import project_root
@@ -332,10 +339,11 @@ class CompileRule(object):
         self.compute_crc = compute_crc
         self.trumped_by = trumped_by
 
-        # This turns each {var} into a regexp named-group named 'brace_var',
-        # and each {{var}} into a group named bracebrace_var.
-        self.output_re = compile_util._extended_fnmatch_compile(
-            self.output_pattern)
+        # We don't compile output_re until someone needs it: most
+        # processes only ever look up files in a few genfiles/ subdirs,
+        # so most rules are never matched against (see
+        # find_compile_rule()), and there are a lot of rules.
+        self._output_re = None
         self.num_vars_in_output_pattern = output_pattern.count('{')
         self.num_dirparts_in_output_pattern = output_pattern.count(os.sep)
         literal_extension = (
@@ -358,6 +366,16 @@ class CompileRule(object):
                         '%s: We do not support globbing over generated files'
                         % ip)
 
+    @property
+    def output_re(self):
+        if self._output_re is None:
+            # This turns each {var} into a regexp named-group named
+            # 'brace_var', and each {{var}} into a group named
+            # bracebrace_var.
+            self._output_re = compile_util._extended_fnmatch_compile(
+                self.output_pattern)
+        return self._output_re
+
     def matches(self, output_filename):
         """True if filename could be produced by this output rule."""
         return self.output_re.match(output_filename) is not None
@@ -6,9 +6,15 @@ try:
     import cPickle
 except ImportError:
     import pickle      # python3
+import atexit
+import fcntl
 import glob
+import hashlib
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
 
 from . import filemod_db
 from . import log
@@ -245,5 +251,256 @@ class CachedFile(object):
             cached_file.clear()
 
 
+# Where ContentCache keeps the fingerprints of its input files: a map
+# from filename (relative to ka-root) to (size, mtime, cache key).
+# Computing a cache key means reading the whole file, so we only do it
+# when a file's size or mtime has changed.  Like filemod_db's crc
+# cache, this assumes that a file with the same size and mtime as
+# before has the same contents.
+_FINGERPRINTS_FILE = os.path.join('genfiles', '_content_cache',
+                                  'fingerprints.pickle')
+# The fingerprints we've read from disk, and the project-root we read
+# them for.
+_FINGERPRINTS = None
+_FINGERPRINTS_ROOT = None
+# The fingerprints we've computed that aren't on disk yet.
+_NEW_FINGERPRINTS = {}
+# ContentCache.sync() rewrites the whole fingerprints file, so it waits
+# until it has at least this many new fingerprints to save.  We save
+# any leftovers at exit.
+_MIN_NEW_FINGERPRINTS_TO_SYNC = 64
+
+# The ContentCache version-dirs we've removed stale versions alongside of.
+_CLEANED_CONTENT_CACHE_DIRS = set()
+
+
+def _read_fingerprints(root):
+    try:
+        with open(os.path.join(root, _FINGERPRINTS_FILE), 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return {}
+
+
+def _fingerprints():
+    """Return the fingerprints map, reading it from disk if need be."""
+    global _FINGERPRINTS, _FINGERPRINTS_ROOT
+    # When testing, ka-root can change between one call and the next.
+    if _FINGERPRINTS is None or _FINGERPRINTS_ROOT != project_root.root:
+        _FINGERPRINTS = _read_fingerprints(project_root.root)
+        _FINGERPRINTS_ROOT = project_root.root
+        _NEW_FINGERPRINTS.clear()
+    return _FINGERPRINTS
+
+
+class ContentCache(object):
+    """A cache of build outputs, keyed on the contents of their inputs.
+
+    kake decides what to rebuild based on mtimes, but mtimes can change
+    without file contents changing (a branch switch, say).  Rules with
+    an expensive build step can use this class to find the output they
+    built from the same input bytes before, and copy it into place
+    rather than rebuilding.
+
+    Entries live in genfiles/_content_cache/<name>/v<version>/<env>/,
+    where <version> is typically the compile rule's version(), and
+    <env> is a hash of the files besides the input that affect the
+    output, such as the compiler.  The env files can change back and
+    forth when switching branches, so we keep entries for every env.
+    But when the version changes, we delete the entries for the old
+    version(s), to keep the cache from growing forever.
+    """
+    def __init__(self, name, env_files, env_version):
+        """Set up the cache for one invocation of a build rule.
+
+        name: the name of the cache; should be unique per build rule.
+        env_files: files, relative to ka-root, that affect the output
+           besides the input file itself, such as the compiler.
+        env_version: typically the compile rule's version().
+        """
+        env_hash = hashlib.sha256()
+        for env_file in env_files:
+            env_hash.update('\0%s\0' % env_file)
+            with open(project_root.join(env_file), 'rb') as f:
+                env_hash.update(f.read())
+        version_dir = project_root.join('genfiles', '_content_cache', name,
+                                        'v%s' % env_version)
+        self._dir = os.path.join(version_dir, env_hash.hexdigest())
+
+        # It's enough to clean up once per process.
+        if version_dir not in _CLEANED_CONTENT_CACHE_DIRS:
+            self._remove_stale_versions(version_dir)
+            _CLEANED_CONTENT_CACHE_DIRS.add(version_dir)
+
+    @staticmethod
+    def _remove_stale_versions(version_dir):
+        """Remove the entries for every version but ours."""
+        cache_dir = os.path.dirname(version_dir)
+        try:
+            subdirs = os.listdir(cache_dir)
+        except OSError:      # we've never made this cache before
+            return
+        for subdir in subdirs:
+            if (subdir.startswith('v') and
+                    os.path.join(cache_dir, subdir) != version_dir):
+                log.v2('Removing stale entries from %s/%s',
+                       cache_dir, subdir)
+                shutil.rmtree(os.path.join(cache_dir, subdir),
+                              ignore_errors=True)
+
+    def key(self, input_filename):
+        """Return the cache key for input_filename, relative to ka-root.
+
+        The filename is part of the key since it can show up in the
+        output (in sourcemaps, say).
+        """
+        s = os.stat(project_root.join(input_filename))
+        fingerprints = _fingerprints()
+        fingerprint = fingerprints.get(input_filename)
+        if fingerprint and fingerprint[:2] == (s.st_size, s.st_mtime):
+            return fingerprint[2]
+
+        key_hash = hashlib.sha256(input_filename + '\0')
+        with open(project_root.join(input_filename), 'rb') as f:
+            key_hash.update(f.read())
+        fingerprint = (s.st_size, s.st_mtime, key_hash.hexdigest())
+        fingerprints[input_filename] = fingerprint
+        _NEW_FINGERPRINTS[input_filename] = fingerprint
+        return fingerprint[2]
+
+    @staticmethod
+    def sync(force=False):
+        """Save the fingerprints computed by key() to disk.
+
+        Call this after computing keys, so later kake runs don't have
+        to recompute them.  Since this rewrites the whole fingerprints
+        file, it does nothing until there are enough new fingerprints
+        to be worth it, unless force is True.
+
+        We merge with what's on disk, since other processes may be
+        syncing too, and hold a lock while we do so that we don't
+        drop each other's fingerprints.
+        """
+        global _FINGERPRINTS
+        if not _NEW_FINGERPRINTS:
+            return
+        if (not force and
+                len(_NEW_FINGERPRINTS) < _MIN_NEW_FINGERPRINTS_TO_SYNC):
+            return
+        if not os.path.isdir(_FINGERPRINTS_ROOT):
+            return    # probably a test tmpdir that's been deleted
+        fingerprints_file = os.path.join(_FINGERPRINTS_ROOT,
+                                         _FINGERPRINTS_FILE)
+        try:
+            os.makedirs(os.path.dirname(fingerprints_file))
+        except (IOError, OSError):
+            pass    # a concurrent process could have made this dir
+        with open(fingerprints_file + '.lock', 'w') as lockfile:
+            fcntl.lockf(lockfile, fcntl.LOCK_EX)
+            fingerprints = _read_fingerprints(_FINGERPRINTS_ROOT)
+            fingerprints.update(_NEW_FINGERPRINTS)
+            (fd, tmpname) = tempfile.mkstemp(
+                dir=os.path.dirname(fingerprints_file))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    cPickle.dump(fingerprints, f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmpname, fingerprints_file)
+            except Exception:
+                os.unlink(tmpname)
+                raise
+        _FINGERPRINTS = fingerprints
+        _NEW_FINGERPRINTS.clear()
+
+    def get(self, key, output_filename, suffix=''):
+        """Copy the cached output into output_filename if it exists.
+
+        suffix distinguishes between multiple outputs built from the
+        same input.  Returns True if we found the output in the cache.
+        """
+        try:
+            shutil.copyfile(os.path.join(self._dir, key + suffix),
+                            project_root.join(output_filename))
+        except IOError as why:
+            if why.errno == 2:      # "No such file or directory"
+                return False
+            raise
+        log.v3('Copied %s from the content cache', output_filename)
+        return True
+
+    def put(self, key, output_filename, suffix=''):
+        """Store output_filename, relative to ka-root, in the cache."""
+        try:
+            os.makedirs(self._dir)
+        except (IOError, OSError):
+            pass    # a concurrent process could have made this dir
+        # We copy to a tempfile and rename so concurrent builds never
+        # see a partially written cache entry.  We copy rather than
+        # hard-link so a later in-place write to the output can't
+        # corrupt the cache.
+        (fd, tmpname) = tempfile.mkstemp(dir=self._dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with open(project_root.join(output_filename), 'rb') as inf:
+                    shutil.copyfileobj(inf, f)
+            os.rename(tmpname, os.path.join(self._dir, key + suffix))
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+
+def map_in_subprocesses(fn, args_list, min_args_for_pool, initializer=None):
+    """Call fn on each element of args_list, in sub-processes if worth it.
+
+    This is for build_many() methods of rules whose per-file work is
+    cpu-bound.  We only start a pool of sub-processes if there are at
+    least min_args_for_pool elements of args_list; for fewer, starting
+    the pool costs more than it saves.  fn and initializer must be
+    top-level functions, so the pool can pickle them.
+    """
+    # multiprocessing does not let daemon processes -- such as the
+    # workers of kake's own build pool -- have children, but in
+    # that case kake is already building files in parallel.
+    if (len(args_list) < min_args_for_pool or
+            multiprocessing.current_process().daemon):
+        for args in args_list:
+            fn(args)
+        return
+
+    pool = multiprocessing.Pool(max(multiprocessing.cpu_count() - 2, 1),
+                                initializer=initializer)
+    try:
+        pool.map(fn, args_list)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def split_outputs_evenly(outfile_infiles_changed_context, num_processes):
+    """Split the outputs into one equal-sized chunk per process.
+
+    This is a split_outputs() for rules that use map_in_subprocesses()
+    in build_many(): when kake builds with just one process, we leave
+    it to build_many() to parallelize.
+    """
+    if num_processes == 1:
+        yield outfile_infiles_changed_context
+    else:
+        chunk_size = ((len(outfile_infiles_changed_context) - 1)
+                      / num_processes + 1)
+        for i in xrange(0, len(outfile_infiles_changed_context), chunk_size):
+            yield outfile_infiles_changed_context[i:i + chunk_size]
+
+
+@atexit.register
+def _atexit_sync():
+    # This function isn't meant to be called manually.  It saves
+    # whatever fingerprints ContentCache.sync() was holding back.
+    ContentCache.sync(force=True)
+
+
 def reset_for_tests():
+    global _FINGERPRINTS
     CachedFile.clear_all()
+    _FINGERPRINTS = None
+    _NEW_FINGERPRINTS.clear()
+    _CLEANED_CONTENT_CACHE_DIRS.clear()
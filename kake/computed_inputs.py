@@ -331,7 +331,8 @@ class ComputedIncludeInputs(ComputedInputsBase):
               base_file.  It should have exactly one group (thing in
               parentheses) that returns the filename to include.  This
               filename is *ALWAYS* taken to be relative to the input
-              filename.
+              filename.  This may also be an already-compiled regexp,
+              for callers that share one regexp between instances.
             other_inputs: additional files (actually, any file-
               patterns) that the outfile depends on, in addition
               to whatever we auto-discover via include-processing.
@@ -347,7 +348,11 @@ class ComputedIncludeInputs(ComputedInputsBase):
         super(ComputedIncludeInputs, self).__init__(['include-inputs dummy'],
                                                     compute_crc)
         self.base_file_pattern = base_file_pattern
-        self.include_regexp = re.compile(include_regexp_string, re.MULTILINE)
+        if isinstance(include_regexp_string, basestring):
+            self.include_regexp = re.compile(include_regexp_string,
+                                             re.MULTILINE)
+        else:
+            self.include_regexp = include_regexp_string
         self.other_inputs = other_inputs
 
         self.clear_caches()
@@ -490,13 +495,19 @@ class ComputedIncludeInputs(ComputedInputsBase):
         # Start with the base-file and then add from there.
         retval = compile_util.resolve_patterns([self.base_file_pattern],
                                                context)
+        # We keep our own set of what's in retval, rather than using
+        # _unique_extend(), which would rebuild it for every file and
+        # make this quadratic in the size of the include-graph.
+        retval_set = set(retval)
         i = 0
         while i < len(retval):
             # We yield here to let the build system build this trigger file,
             # if necessary
             yield retval[i]
-            _unique_extend(retval, self.included_files(retval[i],
-                                                        context))
+            new_files = [f for f in self.included_files(retval[i], context)
+                         if f not in retval_set]
+            retval.extend(new_files)
+            retval_set.update(new_files)
             i += 1
 
     def input_patterns(self, outfile_name, context, triggers, changed):
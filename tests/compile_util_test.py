@@ -155,5 +155,181 @@ class TestCachedFile(testutil.KakeTestBase):
         self.assertEqual({'a': 'b', 'c': 'd', 'e': 'f'}, actual2)
 
 
+class TestContentCache(testutil.KakeTestBase):
+    def setUp(self):
+        super(TestContentCache, self).setUp()    # sets up self.tmpdir
+        self._write('compiler', 'compiler v1')
+        self._write('in.js', 'var x;')
+
+    def _write(self, filename, contents):
+        with open(self._abspath(filename), 'w') as f:
+            f.write(contents)
+
+    def _cache(self, version=1):
+        return compile_util.ContentCache('test', ['compiler'], version)
+
+    def test_miss(self):
+        cache = self._cache()
+        self.assertFalse(cache.get(cache.key('in.js'), 'out.js'))
+        self.assertFileDoesNotExist('out.js')
+
+    def test_hit(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+        os.unlink(self._abspath('out.js'))
+
+        cache = self._cache()
+        self.assertTrue(cache.get(cache.key('in.js'), 'out.js'))
+        self.assertFile('out.js', 'compiled')
+
+    def test_suffix(self):
+        cache = self._cache()
+        key = cache.key('in.js')
+        self._write('out.js', 'compiled')
+        self._write('out.js.map', 'map')
+        cache.put(key, 'out.js')
+        cache.put(key, 'out.js.map', suffix='.map')
+        self.assertTrue(cache.get(key, 'new.js.map', suffix='.map'))
+        self.assertFile('new.js.map', 'map')
+
+    def test_input_contents_change(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+        self._write('in.js', 'var y;')
+        self.assertFalse(cache.get(cache.key('in.js'), 'new.js'))
+
+    def test_input_filename_change(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+        self._write('in2.js', 'var x;')
+        self.assertFalse(cache.get(cache.key('in2.js'), 'new.js'))
+
+    def test_environment_change(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+
+        cache = self._cache(version=2)
+        self.assertFalse(cache.get(cache.key('in.js'), 'new.js'))
+
+        self._write('compiler', 'compiler v2')
+        cache = self._cache()
+        self.assertFalse(cache.get(cache.key('in.js'), 'new.js'))
+
+    def test_environment_change_removes_old_entries(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+        self._cache(version=2)
+
+        compile_util.reset_for_tests()      # pretend we're a new process
+        cache = self._cache()
+        self.assertFalse(cache.get(cache.key('in.js'), 'new.js'))
+
+    def test_env_file_change_keeps_old_entries(self):
+        cache = self._cache()
+        self._write('out.js', 'compiled')
+        cache.put(cache.key('in.js'), 'out.js')
+
+        compile_util.reset_for_tests()      # pretend we're a new process
+        self._write('compiler', 'compiler v2')
+        self._cache()
+
+        # Like switching back to the branch we started on.
+        compile_util.reset_for_tests()
+        self._write('compiler', 'compiler v1')
+        cache = self._cache()
+        self.assertTrue(cache.get(cache.key('in.js'), 'new.js'))
+
+    def test_fingerprint_cache(self):
+        os.utime(self._abspath('in.js'), (1000, 1000))
+        cache = self._cache()
+        key = cache.key('in.js')
+        # Same size and mtime, so we shouldn't even look at the contents.
+        self._write('in.js', 'var y;')
+        os.utime(self._abspath('in.js'), (1000, 1000))
+        self.assertEqual(key, cache.key('in.js'))
+
+        os.utime(self._abspath('in.js'), (1010, 1010))
+        self.assertNotEqual(key, cache.key('in.js'))
+
+    def test_sync_fingerprints(self):
+        os.utime(self._abspath('in.js'), (1000, 1000))
+        cache = self._cache()
+        key = cache.key('in.js')
+        compile_util.ContentCache.sync(force=True)
+        self.assertFileExists('genfiles/_content_cache/fingerprints.pickle')
+
+        # Make sure a new process would see the fingerprint too.
+        compile_util.reset_for_tests()
+        self._write('in.js', 'var y;')
+        os.utime(self._abspath('in.js'), (1000, 1000))
+        self.assertEqual(key, self._cache().key('in.js'))
+
+    def test_sync_waits_for_enough_fingerprints(self):
+        self._cache().key('in.js')
+        compile_util.ContentCache.sync()
+        self.assertFileDoesNotExist(
+            'genfiles/_content_cache/fingerprints.pickle')
+        compile_util.ContentCache.sync(force=True)
+        self.assertFileExists('genfiles/_content_cache/fingerprints.pickle')
+
+    def test_sync_merges_with_other_processes(self):
+        self._write('in2.js', 'var z;')
+        cache = self._cache()
+        key = cache.key('in.js')
+        compile_util.ContentCache.sync(force=True)
+
+        # Pretend another process had read fingerprints before our sync.
+        compile_util.reset_for_tests()
+        compile_util._FINGERPRINTS = {}
+        compile_util._FINGERPRINTS_ROOT = self.tmpdir
+        key2 = cache.key('in2.js')
+        compile_util.ContentCache.sync(force=True)
+
+        compile_util.reset_for_tests()
+        self.assertEqual({'in.js': key, 'in2.js': key2},
+                         {f: v[2] for (f, v)
+                          in compile_util._fingerprints().iteritems()})
+
+
+
+def _write_pid(filename):
+    """Used by TestMapInSubprocesses; top-level so Pool.map() can pickle it."""
+    with open(filename, 'w') as f:
+        f.write(str(os.getpid()))
+
+
+class TestMapInSubprocesses(testutil.KakeTestBase):
+    def _pids(self, num_files, min_args_for_pool):
+        filenames = [self._abspath('pid%s' % i) for i in xrange(num_files)]
+        compile_util.map_in_subprocesses(_write_pid, filenames,
+                                         min_args_for_pool)
+        pids = set()
+        for filename in filenames:
+            with open(filename) as f:
+                pids.add(int(f.read()))
+        return pids
+
+    def test_few_args_run_serially(self):
+        self.assertEqual({os.getpid()}, self._pids(3, 4))
+
+    def test_many_args_run_in_pool(self):
+        self.assertNotIn(os.getpid(), self._pids(4, 4))
+
+
+class TestSplitOutputsEvenly(testutil.KakeTestBase):
+    def test_one_process(self):
+        self.assertEqual([range(5)],
+                         list(compile_util.split_outputs_evenly(range(5), 1)))
+
+    def test_several_processes(self):
+        self.assertEqual([[0, 1], [2, 3], [4]],
+                         list(compile_util.split_outputs_evenly(range(5), 3)))
+
+
 if __name__ == '__main__':
     testutil.main()
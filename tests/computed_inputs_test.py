@@ -679,6 +679,16 @@ class TestComputedIncludes(TestBase):
             self.assertEqual(['a.c', 'a1'],
                              cr.input_files('genfiles/a.ii'))
 
+    def test_compiled_include_regexp(self):
+        cr = compile_rule.find_compile_rule('genfiles/a.ii')
+        includer = computed_inputs.ComputedIncludeInputs(
+            '{{path}}.c', re.compile(r'^#include\s+"(.*?)"', re.MULTILINE),
+            other_inputs=['a1'])
+        with mock.patch.object(cr, 'input_patterns', includer):
+            self.assertEqual(['a.c', 'a.h', 'includes/b.h', 'includes/c.h',
+                              'a1'],
+                             cr.input_files('genfiles/a.ii'))
+
     def test_recompute_inputs_if_other_includes_changes(self):
         cr = compile_rule.find_compile_rule('genfiles/a.ii')
         self.assertEqual(['a.c', 'a.h', 'includes/b.h', 'includes/c.h', 'a1'],
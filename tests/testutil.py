@@ -56,13 +56,23 @@ with open(args[1], 'w') as outfile:
 """
 
 _FAKE_AUTOPREFIXER = """\
-#!/usr/bin/env python
-import sys
-assert sys.argv[1] == '-o'
-with open(sys.argv[2], 'w') as outfile:
-    with open(sys.argv[-1]) as infile:
-        for line in infile:
-            outfile.write(line)
+module.exports = function(options) {
+    return { postcssPlugin: "autoprefixer", options: options };
+};
+"""
+
+# Instead of a real sourcemap, we write out the options each plugin
+# was created with, so tests can check what autoprefixer was given.
+_FAKE_POSTCSS = """\
+module.exports = function(plugins) {
+    return {
+        process: function(css, opts) {
+            var options = plugins.map(function(p) { return p.options; });
+            return { css: css, map: JSON.stringify({ file: opts.to,
+                                                     plugins: options }) };
+        }
+    };
+};
 """
 
 _FAKE_HANDLEBARS_COMPILER = """\
@@ -114,15 +124,32 @@ def _fake_npm_build(self, outfile_infiles_changed_context):
                       'w') as f:
                 print >>f, '{}'
             continue
+        elif 'autoprefixer' in outfile_name.split(os.sep):
+            # kake/run_autoprefixer.js does require("autoprefixer").
+            with open(project_root.join('genfiles', 'node_modules',
+                                        'autoprefixer', 'index.js'),
+                      'w') as f:
+                print >>f, _FAKE_AUTOPREFIXER
+            with open(project_root.join('genfiles', 'node_modules',
+                                        'autoprefixer', 'package.json'),
+                      'w') as f:
+                print >>f, '{}'
+            continue
+        elif 'postcss' in outfile_name.split(os.sep):
+            # kake/run_autoprefixer.js runs autoprefixer via postcss.
+            with open(project_root.join('genfiles', 'node_modules',
+                                        'postcss', 'index.js'), 'w') as f:
+                print >>f, _FAKE_POSTCSS
+            with open(project_root.join('genfiles', 'node_modules',
+                                        'postcss', 'package.json'),
+                      'w') as f:
+                print >>f, '{}'
+            continue
         with open(project_root.join(outfile_name), 'w') as f:
             if os.path.basename(outfile_name) == 'lessc':
                 # format is lessc --flags <infile> <outfile>.  We
                 # follow @import's
                 print >>f, _RECURSIVE_PY_CAT
-            if os.path.basename(outfile_name) == 'autoprefixer':
-                # format is autoprefixer -o <outfile> --map <infile>.  We
-                # follow @import's
-                print >>f, _FAKE_AUTOPREFIXER
             elif os.path.basename(outfile_name) in ('cssmin', 'uglifyjs'):
                 # We'll just have the compressors remove newlines and
                 # comments.  We have to run perl from a shell script so